@@ -1,13 +1,40 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Request, Response, request, send_file, jsonify
 from flask_cors import CORS
+import click
 import os
 import subprocess
 import tempfile
 import logging
 import io
 import uuid
+import hashlib
+import json
+import sqlite3
+import contextlib
 import time
 import threading
+import atexit
+import shutil
+import functools
+import math
+import heapq
+import itertools
+import zipfile
+import fcntl
+import secrets
+import errno
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import pikepdf
+except ImportError:  # Optional: enables image analysis
+    pikepdf = None
+try:
+    import image_worker
+except ImportError:  # Optional: needs Pillow and NumPy, enables the re-encoding engine
+    image_worker = None
 
 # --- Basic Configuration ---
 app = Flask(__name__)
@@ -15,34 +42,1987 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 CORS(app)
 
 # --- Temporary File Storage ---
-# In a real production app, use a more robust cache like Redis or a scheduled job.
-TEMP_FILE_CACHE = {}
+# File IDs, content-addressed artifacts and async job records live behind a cache
+# backend. Every file_id handed to a client points at the SHA-256 of its upload, and
+# each distinct upload owns one baseline plus its adjusted outputs (keyed by DPI), so
+# identical documents share artifacts. The SQLite backend keeps this registry in a
+# file every worker process on the host can see, which lets gunicorn run more than
+# one worker; the memory backend keeps the old single-process dicts.
+#
+# Artifacts on disk are bounded by CACHE_MAX_BYTES: when the total goes over, the
+# least recently used baselines/outputs are evicted. A baseline is touched whenever
+# its file_id or one of its outputs is used, so outputs go before their baseline.
+# File IDs expire CACHE_EXPIRATION_SECONDS after their last access (sliding TTL).
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', os.path.join(tempfile.gettempdir(), 'pdf-compressor-cache.sqlite3'))
 CACHE_EXPIRATION_SECONDS = 3600  # 1 hour
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # 2 GiB
+
+CACHE_COUNTERS = ('evicted_baselines', 'evicted_outputs', 'evicted_bytes', 'expired_file_ids', 'expired_contents')
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class CacheBackend:
+    def attach_file_id(self, file_id, digest):
+        # Points a new file_id at existing content; returns the baseline path or None
+        raise NotImplementedError
+
+    def add_content(self, digest, baseline_path, file_id):
+        # Registers a freshly built baseline; returns the baseline path that won
+        raise NotImplementedError
+
+    def lookup(self, file_id):
+        # Returns (digest, baseline_path), or (None, None) for unknown IDs; counts as an access
+        raise NotImplementedError
+
+    def get_output(self, digest, resolution):
+        # Counts as an access of the output and its baseline
+        raise NotImplementedError
+
+    def set_output(self, digest, resolution, path):
+        # Returns (stored, replaced_path); stored is False once the content expired
+        raise NotImplementedError
+
+    def list_outputs(self, digest):
+        # Returns {dpi: (path, size)} without counting as an access
+        raise NotImplementedError
+
+    def referenced_paths(self):
+        # Every baseline and output path the registry points at
+        raise NotImplementedError
+
+    def expire(self, max_age):
+        # Drops idle file IDs and unreferenced content; returns the paths to delete
+        raise NotImplementedError
+
+    def evict(self, max_bytes, keep_path=None):
+        # Evicts least recently used artifacts until under max_bytes; returns the paths to delete
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def get_meta(self, digest, key):
+        # Derived per-content data (analysis, estimates); dropped along with the content
+        raise NotImplementedError
+
+    def set_meta(self, digest, key, value):
+        raise NotImplementedError
+
+    def save_job(self, job_id, job):
+        raise NotImplementedError
+
+    def update_job(self, job_id, **fields):
+        raise NotImplementedError
+
+    def get_job(self, job_id):
+        raise NotImplementedError
+
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self):
+        self.files = {}     # {file_id: {'digest': ..., 'accessed': ...}}
+        self.contents = {}  # {digest: {'path', 'size', 'accessed', 'outputs': {dpi: {...}}, 'meta': {}, 'file_ids': set()}}
+        self.jobs = {}      # {job_id: {...}}
+        self.counters = dict.fromkeys(CACHE_COUNTERS, 0)
+        self.lock = threading.Lock()
+
+    def attach_file_id(self, file_id, digest):
+        with self.lock:
+            content = self.contents.get(digest)
+            if content is None or not os.path.exists(content['path']):
+                return None
+            now = time.time()
+            content['file_ids'].add(file_id)
+            content['accessed'] = now
+            self.files[file_id] = {'digest': digest, 'accessed': now}
+            return content['path']
+
+    def add_content(self, digest, baseline_path, file_id):
+        with self.lock:
+            now = time.time()
+            content = self.contents.setdefault(digest, {
+                'path': baseline_path, 'size': file_size(baseline_path), 'accessed': now,
+                'outputs': {}, 'meta': {}, 'file_ids': set()
+            })
+            content['file_ids'].add(file_id)
+            content['accessed'] = now
+            self.files[file_id] = {'digest': digest, 'accessed': now}
+            return content['path']
+
+    def lookup(self, file_id):
+        with self.lock:
+            entry = self.files.get(file_id)
+            content = self.contents.get(entry['digest']) if entry else None
+            if content is None:
+                return None, None
+            entry['accessed'] = content['accessed'] = time.time()
+            return entry['digest'], content['path']
+
+    def get_output(self, digest, resolution):
+        with self.lock:
+            content = self.contents.get(digest)
+            output = content['outputs'].get(resolution) if content else None
+            if output is None:
+                return None
+            output['accessed'] = content['accessed'] = time.time()
+            return output['path']
+
+    def set_output(self, digest, resolution, path):
+        with self.lock:
+            content = self.contents.get(digest)
+            if content is None:
+                return False, None
+            now = time.time()
+            previous = content['outputs'].get(resolution)
+            content['outputs'][resolution] = {'path': path, 'size': file_size(path), 'accessed': now}
+            content['accessed'] = now
+            replaced_path = previous['path'] if previous else None
+            return True, replaced_path if replaced_path != path else None
+
+    def list_outputs(self, digest):
+        with self.lock:
+            content = self.contents.get(digest)
+            if content is None:
+                return {}
+            return {resolution: (output['path'], output['size']) for resolution, output in content['outputs'].items()}
+
+    def referenced_paths(self):
+        with self.lock:
+            paths = set()
+            for content in self.contents.values():
+                paths.add(content['path'])
+                paths.update(output['path'] for output in content['outputs'].values())
+            return paths
+
+    def _drop_content(self, digest):
+        # Must be called with the lock held; returns the artifact paths
+        content = self.contents.pop(digest)
+        for file_id in content['file_ids']:
+            self.files.pop(file_id, None)
+        return [content['path']] + [output['path'] for output in content['outputs'].values()]
+
+    def expire(self, max_age):
+        now = time.time()
+        paths = []
+        with self.lock:
+            expired_ids = [
+                file_id for file_id, data in self.files.items()
+                if now - data['accessed'] > max_age
+            ]
+            for file_id in expired_ids:
+                digest = self.files.pop(file_id)['digest']
+                self.counters['expired_file_ids'] += 1
+                content = self.contents.get(digest)
+                if content is None:
+                    continue
+                content['file_ids'].discard(file_id)
+                # Artifacts go away once no live file_id references the content
+                if not content['file_ids']:
+                    paths.extend(self._drop_content(digest))
+                    self.counters['expired_contents'] += 1
+            # Finished job records expire on the same schedule as file IDs
+            for job_id in [
+                job_id for job_id, job in self.jobs.items()
+                if job['state'] in ('done', 'failed') and now - job['updated'] > max_age
+            ]:
+                del self.jobs[job_id]
+        return paths
+
+    def _usage(self):
+        return sum(
+            content['size'] + sum(output['size'] for output in content['outputs'].values())
+            for content in self.contents.values()
+        )
+
+    def evict(self, max_bytes, keep_path=None):
+        paths = []
+        with self.lock:
+            usage = self._usage()
+            if usage <= max_bytes:
+                return paths
+            candidates = []
+            for digest, content in self.contents.items():
+                candidates.append((content['accessed'], digest, None, content))
+                for resolution, output in content['outputs'].items():
+                    candidates.append((output['accessed'], digest, resolution, output))
+            candidates.sort(key=lambda candidate: candidate[0])
+            for _, digest, resolution, artifact in candidates:
+                if usage <= max_bytes:
+                    break
+                content = self.contents.get(digest)
+                if content is None or artifact['path'] == keep_path:
+                    continue
+                if resolution is None:
+                    if any(output['path'] == keep_path for output in content['outputs'].values()):
+                        continue
+                    freed = artifact['size'] + sum(output['size'] for output in content['outputs'].values())
+                    usage -= freed
+                    self.counters['evicted_baselines'] += 1
+                    self.counters['evicted_outputs'] += len(content['outputs'])
+                    self.counters['evicted_bytes'] += freed
+                    paths.extend(self._drop_content(digest))
+                elif content['outputs'].get(resolution) is artifact:
+                    del content['outputs'][resolution]
+                    usage -= artifact['size']
+                    self.counters['evicted_outputs'] += 1
+                    self.counters['evicted_bytes'] += artifact['size']
+                    paths.append(artifact['path'])
+        return paths
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                bytes=self._usage(),
+                file_ids=len(self.files),
+                contents=len(self.contents),
+                outputs=sum(len(content['outputs']) for content in self.contents.values())
+            )
+
+    def get_meta(self, digest, key):
+        with self.lock:
+            content = self.contents.get(digest)
+            return content['meta'].get(key) if content else None
+
+    def set_meta(self, digest, key, value):
+        with self.lock:
+            content = self.contents.get(digest)
+            if content is not None:
+                content['meta'][key] = value
+
+    def save_job(self, job_id, job):
+        with self.lock:
+            self.jobs[job_id] = dict(job)
+
+    def update_job(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated=time.time())
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+class SQLiteCacheBackend(CacheBackend):
+    SCHEMA_VERSION = 3
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY, digest TEXT NOT NULL, accessed REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+        CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed);
+        CREATE TABLE IF NOT EXISTS contents (
+            digest TEXT PRIMARY KEY, baseline_path TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS outputs (
+            digest TEXT NOT NULL, resolution INTEGER NOT NULL, path TEXT NOT NULL,
+            size INTEGER NOT NULL, accessed REAL NOT NULL,
+            PRIMARY KEY (digest, resolution));
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS metadata (
+            digest TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (digest, key));
+    """
+    TABLES = ('files', 'contents', 'outputs', 'jobs', 'counters', 'metadata')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.transaction() as conn:
+            # The registry is a cache: on a schema change start over rather than migrate
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                for table in self.TABLES:
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+                conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            for statement in self.SCHEMA.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+
+    def connect(self):
+        # One connection per thread; WAL lets readers in other workers proceed during writes
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _count(self, conn, name, amount=1):
+        conn.execute(
+            'INSERT INTO counters VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+
+    def attach_file_id(self, file_id, digest):
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT baseline_path FROM contents WHERE digest = ?', (digest,)).fetchone()
+            if row is None or not os.path.exists(row[0]):
+                return None
+            conn.execute('INSERT INTO files VALUES (?, ?, ?)', (file_id, digest, now))
+            conn.execute('UPDATE contents SET accessed = ? WHERE digest = ?', (now, digest))
+            return row[0]
+
+    def add_content(self, digest, baseline_path, file_id):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO contents VALUES (?, ?, ?, ?)',
+                (digest, baseline_path, file_size(baseline_path), now)
+            )
+            conn.execute('UPDATE contents SET accessed = ? WHERE digest = ?', (now, digest))
+            conn.execute('INSERT INTO files VALUES (?, ?, ?)', (file_id, digest, now))
+            return conn.execute('SELECT baseline_path FROM contents WHERE digest = ?', (digest,)).fetchone()[0]
+
+    def lookup(self, file_id):
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                'SELECT f.digest, c.baseline_path FROM files f JOIN contents c ON c.digest = f.digest WHERE f.file_id = ?',
+                (file_id,)
+            ).fetchone()
+            if row is None:
+                return None, None
+            conn.execute('UPDATE files SET accessed = ? WHERE file_id = ?', (now, file_id))
+            conn.execute('UPDATE contents SET accessed = ? WHERE digest = ?', (now, row[0]))
+            return row[0], row[1]
+
+    def get_output(self, digest, resolution):
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                'SELECT path FROM outputs WHERE digest = ? AND resolution = ?', (digest, resolution)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE outputs SET accessed = ? WHERE digest = ? AND resolution = ?', (now, digest, resolution))
+            conn.execute('UPDATE contents SET accessed = ? WHERE digest = ?', (now, digest))
+            return row[0]
+
+    def set_output(self, digest, resolution, path):
+        now = time.time()
+        with self.transaction() as conn:
+            if conn.execute('SELECT 1 FROM contents WHERE digest = ?', (digest,)).fetchone() is None:
+                return False, None
+            row = conn.execute(
+                'SELECT path FROM outputs WHERE digest = ? AND resolution = ?', (digest, resolution)
+            ).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                (digest, resolution, path, file_size(path), now)
+            )
+            conn.execute('UPDATE contents SET accessed = ? WHERE digest = ?', (now, digest))
+            return True, row[0] if row and row[0] != path else None
+
+    def list_outputs(self, digest):
+        rows = self.connect().execute('SELECT resolution, path, size FROM outputs WHERE digest = ?', (digest,))
+        return {resolution: (path, size) for resolution, path, size in rows}
+
+    def referenced_paths(self):
+        rows = self.connect().execute('SELECT baseline_path FROM contents UNION SELECT path FROM outputs')
+        return {row[0] for row in rows}
+
+    def _drop_content(self, conn, digest):
+        paths = [row[0] for row in conn.execute('SELECT baseline_path FROM contents WHERE digest = ?', (digest,))]
+        paths.extend(row[0] for row in conn.execute('SELECT path FROM outputs WHERE digest = ?', (digest,)))
+        conn.execute('DELETE FROM outputs WHERE digest = ?', (digest,))
+        conn.execute('DELETE FROM metadata WHERE digest = ?', (digest,))
+        conn.execute('DELETE FROM contents WHERE digest = ?', (digest,))
+        conn.execute('DELETE FROM files WHERE digest = ?', (digest,))
+        return paths
+
+    def expire(self, max_age):
+        cutoff = time.time() - max_age
+        paths = []
+        # A single write transaction, so two workers never both claim the same files
+        with self.transaction() as conn:
+            expired = conn.execute('DELETE FROM files WHERE accessed < ?', (cutoff,)).rowcount
+            self._count(conn, 'expired_file_ids', expired)
+            orphaned = [row[0] for row in conn.execute(
+                'SELECT digest FROM contents WHERE digest NOT IN (SELECT digest FROM files)'
+            )]
+            for digest in orphaned:
+                paths.extend(self._drop_content(conn, digest))
+            self._count(conn, 'expired_contents', len(orphaned))
+            conn.execute(
+                "DELETE FROM jobs WHERE updated < ? AND json_extract(data, '$.state') IN ('done', 'failed')",
+                (cutoff,)
+            )
+        return paths
+
+    def evict(self, max_bytes, keep_path=None):
+        paths = []
+        with self.transaction() as conn:
+            usage = conn.execute(
+                'SELECT (SELECT COALESCE(SUM(size), 0) FROM contents) + (SELECT COALESCE(SUM(size), 0) FROM outputs)'
+            ).fetchone()[0]
+            if usage <= max_bytes:
+                return paths
+            candidates = conn.execute("""
+                SELECT accessed, digest, NULL, baseline_path, size FROM contents
+                UNION ALL
+                SELECT accessed, digest, resolution, path, size FROM outputs
+                ORDER BY 1
+            """).fetchall()
+            for _, digest, resolution, path, size in candidates:
+                if usage <= max_bytes:
+                    break
+                if path == keep_path:
+                    continue
+                if resolution is None:
+                    outputs = conn.execute('SELECT path, size FROM outputs WHERE digest = ?', (digest,)).fetchall()
+                    if any(output_path == keep_path for output_path, _ in outputs):
+                        continue
+                    freed = size + sum(output_size for _, output_size in outputs)
+                    usage -= freed
+                    self._count(conn, 'evicted_baselines')
+                    self._count(conn, 'evicted_outputs', len(outputs))
+                    self._count(conn, 'evicted_bytes', freed)
+                    paths.extend(self._drop_content(conn, digest))
+                elif conn.execute(
+                    'DELETE FROM outputs WHERE digest = ? AND resolution = ? AND path = ?', (digest, resolution, path)
+                ).rowcount:
+                    usage -= size
+                    self._count(conn, 'evicted_outputs')
+                    self._count(conn, 'evicted_bytes', size)
+                    paths.append(path)
+        return paths
+
+    def stats(self):
+        conn = self.connect()
+        stats = dict.fromkeys(CACHE_COUNTERS, 0)
+        stats.update(conn.execute('SELECT name, value FROM counters').fetchall())
+        stats['bytes'] = conn.execute(
+            'SELECT (SELECT COALESCE(SUM(size), 0) FROM contents) + (SELECT COALESCE(SUM(size), 0) FROM outputs)'
+        ).fetchone()[0]
+        for name, table in (('file_ids', 'files'), ('contents', 'contents'), ('outputs', 'outputs')):
+            stats[name] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        return stats
+
+    def get_meta(self, digest, key):
+        row = self.connect().execute(
+            'SELECT value FROM metadata WHERE digest = ? AND key = ?', (digest, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, digest, key, value):
+        with self.transaction() as conn:
+            if conn.execute('SELECT 1 FROM contents WHERE digest = ?', (digest,)).fetchone() is not None:
+                conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)', (digest, key, json.dumps(value)))
+
+    def save_job(self, job_id, job):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)', (job_id, json.dumps(job), job['updated']))
+
+    def update_job(self, job_id, **fields):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            job = json.loads(row[0])
+            job.update(fields, updated=time.time())
+            conn.execute('UPDATE jobs SET data = ?, updated = ? WHERE job_id = ?', (json.dumps(job), job['updated'], job_id))
+
+    def get_job(self, job_id):
+        row = self.connect().execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+def create_cache_backend():
+    if CACHE_BACKEND == 'memory':
+        return MemoryCacheBackend()
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteCacheBackend(CACHE_DB_PATH)
+    raise ValueError(f"Unknown CACHE_BACKEND: {CACHE_BACKEND}")
+
+FILE_CACHE = create_cache_backend()
+
+def remove_files(paths):
+    for file_path in paths:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def enforce_cache_budget(keep_path=None):
+    # Called after new artifacts are stored; keep_path is about to be served
+    evicted_paths = FILE_CACHE.evict(CACHE_MAX_BYTES, keep_path=keep_path)
+    if evicted_paths:
+        app.logger.info(f"Evicted {len(evicted_paths)} cached files to stay under {CACHE_MAX_BYTES} bytes.")
+        remove_files(evicted_paths)
+
+# --- Scratch Space ---
+# Uploads, baselines, outputs and intermediate chunks all live in scratch space, which
+# has two tiers: a RAM-backed one (tmpfs, /dev/shm by default) for small, hot files and
+# a disk one. A file goes to RAM when its expected size (usually its source's) is at
+# most SCRATCH_RAM_FILE_MAX_BYTES and the tier stays under SCRATCH_RAM_MAX_BYTES
+# (capped at half the tmpfs); otherwise, or when it is unknown, to disk. Each RAM
+# allocation reserves its expected size until the file is written, so concurrent
+# outputs that have not been written yet count against the tier. Uploads start in RAM
+# and spill to disk once they grow past the file limit, once the tier as a whole goes
+# over its budget, or when the tmpfs itself runs out of space. SCRATCH_RAM_DIR='' turns
+# the RAM tier off.
+#
+# Every name starts with the owning process's tag (<pid>-<random>), and each process
+# holds an flock on owners/<tag>.lock for its lifetime. At startup, files of owners
+# whose lock is free (crashed or stopped workers) are removed unless the cache
+# registry still points at them.
+SCRATCH_DISK_DIR = os.environ.get('SCRATCH_DISK_DIR', os.path.join(tempfile.gettempdir(), 'pdf-compressor'))
+SCRATCH_RAM_DIR = os.environ.get('SCRATCH_RAM_DIR', '/dev/shm/pdf-compressor' if os.path.isdir('/dev/shm') else '')
+SCRATCH_RAM_MAX_BYTES = int(os.environ.get('SCRATCH_RAM_MAX_BYTES', 256 * 1024 * 1024))
+SCRATCH_RAM_FILE_MAX_BYTES = int(os.environ.get('SCRATCH_RAM_FILE_MAX_BYTES', 16 * 1024 * 1024))
+
+class ScratchTier:
+    def __init__(self, name, root, max_bytes=None):
+        self.name = name
+        self.root = root
+        self.max_bytes = max_bytes
+        self.allocated = 0
+
+    def usage(self):
+        # Returns (files, bytes) currently in the tier, whoever created them
+        files = size = 0
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    files += 1
+                    size += entry.stat(follow_symlinks=False).st_size
+                elif entry.is_dir(follow_symlinks=False) and entry.name != 'owners':
+                    for child in os.scandir(entry.path):
+                        files += 1
+                        size += child.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass # Removed while we were looking
+        return files, size
+
+class ScratchSpace:
+    def __init__(self, disk_root, ram_root, ram_max_bytes, ram_file_max_bytes):
+        self.tag = f'{os.getpid()}-{secrets.token_hex(4)}'
+        self.lock = threading.Lock()
+        self.spills = 0
+        self.ram_file_max_bytes = ram_file_max_bytes
+        self.reservations = {}  # RAM path -> reserved bytes
+        self.disk = ScratchTier('disk', disk_root)
+        self.ram = None
+        if ram_root:
+            try:
+                os.makedirs(ram_root, exist_ok=True)
+                # Leave room for everything else that uses the tmpfs
+                capacity = shutil.disk_usage(ram_root).total // 2
+                self.ram = ScratchTier('ram', ram_root, min(ram_max_bytes, capacity))
+            except OSError as e:
+                app.logger.warning(f"RAM scratch tier {ram_root} unavailable: {str(e)}")
+        os.makedirs(disk_root, exist_ok=True)
+        owners_dir = os.path.join(disk_root, 'owners')
+        os.makedirs(owners_dir, exist_ok=True)
+        self.owner_lock = open(os.path.join(owners_dir, f'{self.tag}.lock'), 'w')
+        fcntl.flock(self.owner_lock, fcntl.LOCK_EX)
+
+    def tiers(self):
+        return [tier for tier in (self.ram, self.disk) if tier is not None]
+
+    def _pending_ram_bytes(self):
+        # Reserved bytes a file has not grown into yet; a reservation ends with its file
+        pending = 0
+        with self.lock:
+            for path, reserved in list(self.reservations.items()):
+                try:
+                    pending += max(0, reserved - os.stat(path).st_size)
+                except OSError:
+                    del self.reservations[path]
+        return pending
+
+    def ram_bytes(self):
+        # Bytes in the RAM tier from every process, plus this process's reservations
+        return self.ram.usage()[1] + self._pending_ram_bytes()
+
+    def _choose_tier(self, size_hint):
+        if self.ram is not None and size_hint is not None and size_hint <= self.ram_file_max_bytes:
+            if self.ram_bytes() + size_hint <= self.ram.max_bytes:
+                return self.ram
+        return self.disk
+
+    def _name(self, tier, suffix):
+        with self.lock:
+            tier.allocated += 1
+        return os.path.join(tier.root, f'{self.tag}-{secrets.token_hex(8)}{suffix}')
+
+    def _reserve(self, path, size_hint):
+        if size_hint and self.in_ram(path):
+            with self.lock:
+                self.reservations[path] = size_hint
+
+    def path(self, suffix='.pdf', size_hint=None):
+        # A fresh path in the tier that fits size_hint bytes. Nothing is created, except
+        # an empty placeholder for a RAM reservation, which lasts as long as the file.
+        path = self._name(self._choose_tier(size_hint), suffix)
+        if size_hint and self.in_ram(path):
+            open(path, 'xb').close()
+            self._reserve(path, size_hint)
+        return path
+
+    def directory(self, prefix, size_hint=None):
+        path = self._name(self._choose_tier(size_hint), f'-{prefix.strip("-")}')
+        os.mkdir(path)
+        self._reserve(path, size_hint)
+        return path
+
+    def in_ram(self, path):
+        return self.ram is not None and path.startswith(self.ram.root + os.sep)
+
+    def should_spill(self, path, size):
+        # Checked by writers as a file grows: past the file limit, or the tier's budget
+        if not self.in_ram(path):
+            return False
+        return size > self.ram_file_max_bytes or self.ram_bytes() > self.ram.max_bytes
+
+    def spill(self, path):
+        # Moves a RAM-tier file to disk and returns its new path
+        target_path = self._name(self.disk, os.path.splitext(path)[1])
+        shutil.move(path, target_path)
+        with self.lock:
+            self.spills += 1
+            self.reservations.pop(path, None)
+        return target_path
+
+    def reclaim_orphans(self, referenced_paths):
+        owners_dir = os.path.join(self.disk.root, 'owners')
+        dead_tags = set()
+        for lock_name in os.listdir(owners_dir):
+            tag = lock_name[:-len('.lock')]
+            if tag == self.tag:
+                continue
+            with open(os.path.join(owners_dir, lock_name), 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue # Owner is alive
+                dead_tags.add(tag)
+                os.remove(lock_file.name)
+        reclaimed = reclaimed_bytes = 0
+        for tier in self.tiers():
+            for entry in os.scandir(tier.root):
+                # <pid>-<hex>-<hex>...: the owner tag is the first two dash-separated fields
+                tag = '-'.join(entry.name.split('-')[:2])
+                if tag not in dead_tags or entry.path in referenced_paths:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        reclaimed_bytes += entry.stat(follow_symlinks=False).st_size
+                        os.remove(entry.path)
+                    reclaimed += 1
+                except OSError:
+                    pass
+        if reclaimed:
+            app.logger.info(f"Reclaimed {reclaimed} orphaned scratch files ({reclaimed_bytes} bytes) from {len(dead_tags)} stopped workers")
+        return reclaimed
+
+    def snapshot(self):
+        tiers = {}
+        for tier in self.tiers():
+            files, size = tier.usage()
+            tiers[tier.name] = {
+                "root": tier.root,
+                "files": files,
+                "bytes": size,
+                "max_bytes": tier.max_bytes,
+                "allocated": tier.allocated
+            }
+        with self.lock:
+            reserved = len(self.reservations)
+        return {
+            "tag": self.tag, "ram_file_max_bytes": self.ram_file_max_bytes, "spills": self.spills,
+            "ram_reservations": reserved, "tiers": tiers
+        }
+
+SCRATCH = ScratchSpace(SCRATCH_DISK_DIR, SCRATCH_RAM_DIR, SCRATCH_RAM_MAX_BYTES, SCRATCH_RAM_FILE_MAX_BYTES)
+try:
+    SCRATCH.reclaim_orphans(FILE_CACHE.referenced_paths())
+except OSError as e:
+    app.logger.warning(f"Could not reclaim orphaned scratch files: {str(e)}")
+
+# --- Quality Ladder Precomputation ---
+# When enabled, every DPI of the quality ladder is built in the background as soon as
+# the baseline exists. PENDING_OUTPUTS tracks every in-flight build in this process,
+# background or request-driven, keyed by (digest, DPI).
+PRECOMPUTE_QUALITY_LADDER = os.environ.get('PRECOMPUTE_QUALITY_LADDER', '0') == '1'
+PRECOMPUTE_WORKERS = int(os.environ.get('PRECOMPUTE_WORKERS', 2))
+PRECOMPUTE_EXECUTOR = ThreadPoolExecutor(max_workers=PRECOMPUTE_WORKERS, thread_name_prefix='precompute')
+PENDING_OUTPUTS = {}
+PENDING_OUTPUTS_LOCK = threading.Lock()
 
 # --- Health Check Route ---
 @app.route('/', methods=['GET'])
 def health_check():
     return jsonify({"status": "ok"}), 200
 
+# --- Metrics Route ---
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "cache": dict(FILE_CACHE.stats(), max_bytes=CACHE_MAX_BYTES, ttl_seconds=CACHE_EXPIRATION_SECONDS),
+        "spawn": SPAWN_STATS.snapshot(),
+        "scratch": SCRATCH.snapshot(),
+        "optimize": OPTIMIZE_STATS.snapshot(),
+        "admission": GS_LIMITER.snapshot(),
+        "gs_profiles": {"default": GS_PROFILE, "available": sorted(GS_PROFILES), "tuned": GS_TUNED_PROFILES},
+        "engines": ENGINE_STATS.snapshot()
+    })
+
 # --- Helper function to map slider value to a specific DPI ---
+DPI_MAP = {1: 72, 2: 96, 3: 120, 4: 150, 5: 200, 6: 250, 7: 300, 8: 400, 9: 500, 10: 600}
+
 def get_gs_resolution(quality_value):
     try:
         quality = int(quality_value)
     except (ValueError, TypeError):
         return 300 # Default to a high-quality 300 DPI
-    dpi_map = {1: 72, 2: 96, 3: 120, 4: 150, 5: 200, 6: 250, 7: 300, 8: 400, 9: 500, 10: 600}
-    return dpi_map.get(quality, 300)
+    return DPI_MAP.get(quality, 300)
+
+# --- Process Spawning ---
+# Forking a large gunicorn worker copies its page tables on every gs/qpdf launch. With
+# FAST_SPAWN=1 (default) commands are started with an absolute executable path and
+# close_fds=False, which lets subprocess use posix_spawn/vfork instead of fork+exec.
+# That is safe here because Python creates file descriptors non-inheritable. Spawn
+# latency (time until the child is started) is reported under /metrics.
+FAST_SPAWN = os.environ.get('FAST_SPAWN', '1') == '1'
+
+class SpawnStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.last_seconds = seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "fast_spawn": FAST_SPAWN,
+                "count": self.count,
+                "mean_ms": round(self.total_seconds / self.count * 1000, 3) if self.count else None,
+                "max_ms": round(self.max_seconds * 1000, 3),
+                "last_ms": round(self.last_seconds * 1000, 3)
+            }
+
+SPAWN_STATS = SpawnStats()
+
+@functools.lru_cache(maxsize=None)
+def resolve_executable(name):
+    return shutil.which(name) or name
+
+def spawn_process(command, **popen_kwargs):
+    if FAST_SPAWN:
+        command = [resolve_executable(command[0])] + list(command[1:])
+        popen_kwargs.setdefault('close_fds', False)
+    started = time.perf_counter()
+    process = subprocess.Popen(command, **popen_kwargs)
+    SPAWN_STATS.record(time.perf_counter() - started)
+    return process
+
+def run_process(command, timeout):
+    # subprocess.run(check=True, capture_output=True, text=True) on top of spawn_process
+    with spawn_process(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+# --- Admission Control ---
+# GS_LIMITER caps how many Ghostscript runs execute at once in this worker process
+# (slot) and how many requests may hold admitted Ghostscript work at once (admission):
+# GS_MAX_CONCURRENCY running plus GS_MAX_QUEUE waiting. Beyond that, requests get 429
+# with a Retry-After derived from the queue depth and the observed per-job latency.
+# Work started on behalf of an admitted request or in the background (precompute,
+# chunks, samples) only waits for slots.
+#
+# Slots and admission are shared by all worker processes on the host: a running
+# Ghostscript job holds an flock on one of GS_HOST_SLOTS slot files (one per usable
+# CPU, cgroup quota and affinity aware) and an admitted request on one of
+# GS_MAX_ADMITTED ticket files, both in GS_ADMISSION_DIR (next to the SQLite cache by
+# default). The bounds hold however gunicorn spreads connections, files held by a
+# crashed worker are released by the kernel, and one process may use every idle core,
+# so the chunks, candidates and samples of a single request run in parallel on a quiet
+# host. GS_MAX_CONCURRENCY only caps a single process. GS_ADMISSION_DIR='' (and the
+# memory cache backend) keeps both per process, with each process limited to its share
+# of the CPUs. Workers must run threads (see the Dockerfile) for excess requests to
+# reach the limiter and get their 429 instead of waiting in the listen backlog.
+#
+# Waiting runs are scheduled shortest-job-first (GS_SCHEDULER=sjf, the default) on a
+# cost estimate in seconds built from file size, page count and image bytes. Aging
+# lowers a waiter's cost by GS_SJF_AGING per second waited, so a large job overtakes
+# any job that arrives more than its extra cost later and is never starved.
+# GS_SCHEDULER=fifo restores arrival order. Wait times are reported per cost class.
+WORKER_PROCESSES = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+def detect_cpu_limit():
+    try:
+        cpus = float(len(os.sched_getaffinity(0)))
+    except (AttributeError, OSError):
+        cpus = float(os.cpu_count() or 1)
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()
+            if limit != 'max':
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    return min(cpus, quota) if quota else cpus
+
+CPU_LIMIT = detect_cpu_limit()
+GS_PROCESS_SHARE = max(1, int(CPU_LIMIT // WORKER_PROCESSES))
+GS_ADMISSION_DIR = os.environ.get('GS_ADMISSION_DIR', CACHE_DB_PATH + '.admission' if CACHE_BACKEND == 'sqlite' else '')
+GS_HOST_SLOTS = int(os.environ.get('GS_HOST_SLOTS', max(1, int(CPU_LIMIT))))
+GS_MAX_CONCURRENCY = int(os.environ.get('GS_MAX_CONCURRENCY', GS_HOST_SLOTS if GS_ADMISSION_DIR else GS_PROCESS_SHARE))
+GS_MAX_QUEUE = int(os.environ.get('GS_MAX_QUEUE', GS_PROCESS_SHARE * 4))
+GS_MAX_ADMITTED = int(os.environ.get('GS_MAX_ADMITTED', (GS_PROCESS_SHARE + GS_MAX_QUEUE) * WORKER_PROCESSES))
+GS_SLOT_POLL_SECONDS = 0.05  # How often the next waiter looks for a slot freed by another process
+GS_SCHEDULER = os.environ.get('GS_SCHEDULER', 'sjf').lower()
+GS_SJF_AGING = float(os.environ.get('GS_SJF_AGING', 1.0))
+GS_COST_PER_PAGE = float(os.environ.get('GS_COST_PER_PAGE', 0.05))
+GS_COST_PER_MB = float(os.environ.get('GS_COST_PER_MB', 0.1))
+GS_COST_PER_IMAGE_MB = float(os.environ.get('GS_COST_PER_IMAGE_MB', 0.4))
+# (upper bound in estimated seconds, class name), checked in order
+GS_COST_CLASSES = [(2.0, 'small'), (20.0, 'medium'), (float('inf'), 'large')]
+
+def estimate_job_cost(input_path, page_count=None, inventory=None, first_page=None, last_page=None):
+    # Rough Ghostscript seconds for a pass; page ranges get their share of the document
+    try:
+        size_mb = file_size(input_path) / (1024 * 1024)
+    except OSError:
+        size_mb = 0.0
+    if page_count is None and inventory is not None:
+        page_count = inventory['pages']
+    image_mb = inventory['image_bytes'] / (1024 * 1024) if inventory is not None else 0.0
+    cost = GS_COST_PER_PAGE * (page_count or 1) + GS_COST_PER_MB * size_mb + GS_COST_PER_IMAGE_MB * image_mb
+    if first_page is not None and page_count:
+        cost *= (last_page - first_page + 1) / page_count
+    return cost
+
+def cost_class(cost):
+    for limit, name in GS_COST_CLASSES:
+        if cost < limit:
+            return name
+    return GS_COST_CLASSES[-1][1]
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Compression queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class SharedTickets:
+    # capacity interchangeable tickets, each an flock on a file shared by every process
+    def __init__(self, directory, capacity, prefix):
+        self.directory = directory
+        self.capacity = capacity
+        self.prefix = prefix
+        self.held = []  # Open, locked ticket descriptors
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _ticket_path(self, index):
+        return os.path.join(self.directory, f'{self.prefix}-{index}.lock')
+
+    def try_acquire(self):
+        # Starts at a random ticket so processes do not all probe the same files first
+        start = secrets.randbelow(self.capacity)
+        for offset in range(self.capacity):
+            fd = os.open(self._ticket_path((start + offset) % self.capacity), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            with self.lock:
+                self.held.append(fd)
+            return True
+        return False
+
+    def release(self):
+        # Tickets are interchangeable, so any held one can go
+        with self.lock:
+            fd = self.held.pop()
+        os.close(fd)
+
+    def count(self):
+        # Tickets held by all processes (a probe, for /metrics)
+        held = 0
+        for index in range(self.capacity):
+            path = self._ticket_path(index)
+            if not os.path.exists(path):
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                held += 1
+            finally:
+                os.close(fd)
+        return held
+
+class JobLimiter:
+    def __init__(self, max_running, max_waiting, shared=None, host_slots=None):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.shared = shared
+        self.host_slots = host_slots
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.avg_seconds = 10.0  # Prior until real jobs have been observed
+        self.condition = threading.Condition()
+        self.queue = []  # Heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+        self.class_waits = {name: [0, 0.0, 0.0] for _, name in GS_COST_CLASSES}  # jobs, total, max
+
+    def retry_after(self, admitted, max_running):
+        # Must be called with the condition held
+        queued_rounds = (max(0, admitted - max_running) + 1) / max_running
+        return max(1, int(math.ceil(queued_rounds * self.avg_seconds)))
+
+    def admit(self):
+        with self.condition:
+            if self.shared is None:
+                if self.admitted >= self.max_running + self.max_waiting:
+                    self.rejected += 1
+                    raise QueueFullError(self.retry_after(self.admitted, self.max_running))
+                self.admitted += 1
+                return
+        if not self.shared.try_acquire():
+            with self.condition:
+                self.rejected += 1
+                # Every ticket is taken; all workers' slots drain the queue
+                host_running = self.host_slots.capacity if self.host_slots else self.max_running * WORKER_PROCESSES
+                raise QueueFullError(self.retry_after(self.shared.capacity, host_running))
+        with self.condition:
+            self.admitted += 1
+
+    def release_admission(self):
+        with self.condition:
+            self.admitted -= 1
+        if self.shared is not None:
+            self.shared.release()
+
+    @contextlib.contextmanager
+    def admission(self):
+        self.admit()
+        try:
+            yield
+        finally:
+            self.release_admission()
+
+    def _priority(self, cost, enqueued):
+        if GS_SCHEDULER == 'fifo':
+            return enqueued
+        # cost - aging * (now - enqueued) ranks waiters the same way at any later time
+        return cost + GS_SJF_AGING * enqueued
+
+    def _take_slot(self, ticket):
+        # Must be called with the condition held
+        if self.running >= self.max_running or self.queue[0] is not ticket:
+            return False
+        return self.host_slots is None or self.host_slots.try_acquire()
+
+    @contextlib.contextmanager
+    def slot(self, cost=None):
+        # cost is the estimate from estimate_job_cost; unknown jobs count as average ones
+        enqueued = time.monotonic()
+        with self.condition:
+            if cost is None:
+                cost = self.avg_seconds
+            ticket = (self._priority(cost, enqueued), next(self.sequence))
+            heapq.heappush(self.queue, ticket)
+            self.waiting += 1
+            try:
+                while not self._take_slot(ticket):
+                    # Only the first waiter polls for slots freed by other processes
+                    polling = self.host_slots is not None and self.queue[0] is ticket and self.running < self.max_running
+                    self.condition.wait(GS_SLOT_POLL_SECONDS if polling else None)
+            except BaseException:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+                raise
+            finally:
+                self.waiting -= 1
+            heapq.heappop(self.queue)
+            self.running += 1
+            waited = time.monotonic() - enqueued
+            stats = self.class_waits[cost_class(cost)]
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+            # The next ticket may also fit if more than one slot is free
+            self.condition.notify_all()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            if self.host_slots is not None:
+                self.host_slots.release()
+            with self.condition:
+                self.running -= 1
+                self.completed += 1
+                # Exponentially weighted, so the estimate follows the current mix of jobs
+                self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * elapsed
+                self.condition.notify_all()
+
+    def snapshot(self):
+        shared = {"capacity": self.shared.capacity, "admitted": self.shared.count()} if self.shared else None
+        host_slots = {"capacity": self.host_slots.capacity, "running": self.host_slots.count()} if self.host_slots else None
+        with self.condition:
+            return {
+                "cpu_limit": CPU_LIMIT,
+                "shared_admission": shared,
+                "host_slots": host_slots,
+                "max_running": self.max_running,
+                "max_waiting": self.max_waiting,
+                "admitted": self.admitted,
+                "running": self.running,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_job_seconds": round(self.avg_seconds, 3),
+                "scheduler": GS_SCHEDULER,
+                "wait_by_class": {
+                    name: {
+                        "jobs": jobs,
+                        "avg_wait_seconds": round(total / jobs, 3) if jobs else 0.0,
+                        "max_wait_seconds": round(longest, 3)
+                    }
+                    for name, (jobs, total, longest) in self.class_waits.items()
+                }
+            }
+
+GS_LIMITER = JobLimiter(
+    GS_MAX_CONCURRENCY, GS_MAX_QUEUE,
+    SharedTickets(GS_ADMISSION_DIR, GS_MAX_ADMITTED, 'ticket') if GS_ADMISSION_DIR else None,
+    SharedTickets(GS_ADMISSION_DIR, GS_HOST_SLOTS, 'slot') if GS_ADMISSION_DIR else None
+)
+
+@app.errorhandler(QueueFullError)
+def compression_queue_full(e):
+    response = jsonify({"error": "Server is busy, please retry later.", "retry_after": e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+# --- Ghostscript Profiles ---
+# A profile is a named set of Ghostscript knobs: 'startup' arguments fix device
+# settings (JPEG pass-through), 'distiller' params are set per job (downsample
+# filters). Only pdfwrite knobs belong here: the raster settings (NumRenderingThreads,
+# BandListStorage, BufferSpace, MaxBitmap) drive the banding renderer of image devices
+# and are no-ops for pdfwrite. -dFastWebView is left off since linearizing costs an
+# extra pass over the output and saves no bytes. GS_PROFILES_PATH may point at a JSON
+# file that adds or overrides profiles in the same shape. Each pass uses the profile
+# recorded for its document class by `flask --app app tune-gs <corpus>` (read from
+# GS_TUNING_PATH), falling back to GS_PROFILE. Document classes come from the image
+# inventory: 'text' (no images), 'scan' (mostly image bytes), 'mixed', or 'unknown'.
+GS_PROFILE = os.environ.get('GS_PROFILE', 'default')
+GS_PROFILES_PATH = os.environ.get('GS_PROFILES_PATH')
+GS_TUNING_PATH = os.environ.get('GS_TUNING_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gs-tuning.json'))
+SCAN_IMAGE_RATIO = 0.6  # Share of the file taken by image streams above which a document counts as a scan
+
+def load_gs_profiles():
+    profiles = {
+        'default': {'startup': [], 'distiller': {}},
+        # JPEGs that are not downsampled are copied as they are instead of decoded and re-encoded
+        'passthrough': {'startup': ['-dPassThroughJPEGImages=true'], 'distiller': {}},
+        'average': {
+            'startup': [],
+            'distiller': {
+                'ColorImageDownsampleType': '/Average', 'GrayImageDownsampleType': '/Average',
+                'MonoImageDownsampleType': '/Average'
+            }
+        },
+        'bicubic': {
+            'startup': [],
+            'distiller': {
+                'ColorImageDownsampleType': '/Bicubic', 'GrayImageDownsampleType': '/Bicubic',
+                'MonoImageDownsampleType': '/Subsample'
+            }
+        }
+    }
+    if GS_PROFILES_PATH:
+        with open(GS_PROFILES_PATH) as f:
+            for name, profile in json.load(f).items():
+                profiles[name] = {'startup': list(profile.get('startup', [])), 'distiller': dict(profile.get('distiller', {}))}
+    return profiles
+
+def load_gs_tuning():
+    try:
+        with open(GS_TUNING_PATH) as f:
+            tuning = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        app.logger.warning(f"Ignoring GS tuning file {GS_TUNING_PATH}: {str(e)}")
+        return {}
+    chosen = {}
+    for document_class, result in tuning.get('classes', {}).items():
+        if result.get('profile') in GS_PROFILES:
+            chosen[document_class] = result['profile']
+        else:
+            app.logger.warning(f"GS tuning picks unknown profile {result.get('profile')} for {document_class} documents")
+    return chosen
+
+GS_PROFILES = load_gs_profiles()
+if GS_PROFILE not in GS_PROFILES:
+    raise ValueError(f"Unknown GS_PROFILE: {GS_PROFILE}")
+GS_TUNED_PROFILES = load_gs_tuning()  # {document class: profile name}
+
+def document_class(input_path, inventory):
+    if inventory is None:
+        return 'unknown'
+    if not inventory['images']:
+        return 'text'
+    if inventory['image_bytes'] >= SCAN_IMAGE_RATIO * max(1, file_size(input_path)):
+        return 'scan'
+    return 'mixed'
+
+def select_gs_profile(input_path, inventory=None):
+    return GS_TUNED_PROFILES.get(document_class(input_path, inventory), GS_PROFILE)
+
+def profile_distiller_params(profile_name):
+    return GS_PROFILES[profile_name or GS_PROFILE]['distiller']
+
+def profile_startup_args(profile_name):
+    return GS_PROFILES[profile_name or GS_PROFILE]['startup']
 
 # --- Ghostscript compression function ---
-def run_ghostscript(input_path, output_path, resolution):
-    command = [
-        'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+GS_TIMEOUT_SECONDS = 300
+
+def run_ghostscript(input_path, output_path, resolution, cost=None, profile=None):
+    app.logger.info(f"Running GS with resolution: {resolution} DPI ({profile or GS_PROFILE} profile) on {os.path.basename(input_path)}")
+    run_ghostscript_process(input_path, output_path, resolution, cost=cost, profile=profile)
+
+def pdfwrite_command(output_path, resolution, profile=None):
+    return [
+        'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4'
+    ] + profile_startup_args(profile) + [
         '-dDownsampleColorImages=true', '-dDownsampleGrayImages=true', '-dDownsampleMonoImages=true',
-        f'-dColorImageResolution={resolution}', f'-dGrayImageResolution={resolution}', f'-dMonoImageResolution={resolution}',
-        '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sOutputFile={output_path}', input_path
+        f'-dColorImageResolution={resolution}', f'-dGrayImageResolution={resolution}', f'-dMonoImageResolution={resolution}'
+    ] + [f'-d{name}={value}' for name, value in profile_distiller_params(profile).items()] + [
+        '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sOutputFile={output_path}'
+    ]
+
+def run_ghostscript_process(input_path, output_path, resolution, first_page=None, last_page=None, cost=None, profile=None):
+    command = pdfwrite_command(output_path, resolution, profile)
+    if first_page is not None:
+        command += [f'-dFirstPage={first_page}', f'-dLastPage={last_page}']
+    command.append(input_path)
+    if cost is None:
+        cost = estimate_job_cost(input_path)
+    with GS_LIMITER.slot(cost):
+        run_process(command, timeout=GS_TIMEOUT_SECONDS)
+
+# --- Page-Range Parallel Compression ---
+# A single gs run uses one core. Documents with at least PARALLEL_PAGES_THRESHOLD pages
+# are split into PARALLEL_CHUNK_PAGES-page ranges, compressed by parallel gs processes
+# and merged back into one PDF (with qpdf when installed, otherwise with gs).
+# PARALLEL_PAGES_THRESHOLD=0 turns the mode off.
+PARALLEL_PAGES_THRESHOLD = int(os.environ.get('PARALLEL_PAGES_THRESHOLD', 200))
+PARALLEL_CHUNK_PAGES = max(1, int(os.environ.get('PARALLEL_CHUNK_PAGES', 50)))
+PARALLEL_CHUNK_WORKERS = int(os.environ.get('PARALLEL_CHUNK_WORKERS', max(2, GS_MAX_CONCURRENCY)))
+PARALLEL_CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=PARALLEL_CHUNK_WORKERS, thread_name_prefix='gs-chunk')
+
+def ps_string(value):
+    # Quotes a path as a PostScript string literal
+    escaped = value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return f'({escaped})'
+
+@functools.lru_cache(maxsize=1024)
+def _count_pages(path, mtime, size):
+    # pikepdf only reads the page tree; gs parses the whole document
+    if pikepdf is not None:
+        with pikepdf.open(path) as pdf:
+            return len(pdf.pages)
+    command = [
+        'gs', '-q', '-dNODISPLAY', f'--permit-file-read={path}',
+        '-c', f'{ps_string(path)} (r) file runpdfbegin pdfpagecount = quit'
     ]
-    app.logger.info(f"Running GS with resolution: {resolution} DPI on {os.path.basename(input_path)}")
-    subprocess.run(command, check=True, capture_output=True, text=True, timeout=300)
+    result = run_process(command, timeout=60)
+    return int(result.stdout.strip().splitlines()[-1])
+
+def get_page_count(path, inventory=None):
+    # Returns None when the page count cannot be determined. An image inventory of the
+    # file already holds it, so the file is not opened again.
+    if inventory is not None:
+        return inventory['pages']
+    try:
+        stat = os.stat(path)
+        return _count_pages(path, stat.st_mtime, stat.st_size)
+    except Exception as e:
+        app.logger.warning(f"Could not count pages of {os.path.basename(path)}: {str(e)}")
+        return None
+
+def merge_command(chunk_paths, output_path):
+    if shutil.which('qpdf'):
+        return ['qpdf', '--empty', '--pages'] + chunk_paths + ['--', output_path]
+    return [
+        'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4', '-dAutoRotatePages=/None',
+        '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sOutputFile={output_path}'
+    ] + chunk_paths
+
+def merge_pdfs(chunk_paths, output_path):
+    run_process(merge_command(chunk_paths, output_path), timeout=GS_TIMEOUT_SECONDS)
+
+def run_ghostscript_parallel(input_path, output_path, resolution, page_count, inventory=None, profile=None):
+    chunk_dir = SCRATCH.directory('gs-chunks', size_hint=file_size(input_path))
+    try:
+        futures = []
+        for first_page in range(1, page_count + 1, PARALLEL_CHUNK_PAGES):
+            last_page = min(first_page + PARALLEL_CHUNK_PAGES - 1, page_count)
+            chunk_path = os.path.join(chunk_dir, f'{first_page:06d}.pdf')
+            cost = estimate_job_cost(input_path, page_count, inventory, first_page, last_page)
+            futures.append((chunk_path, PARALLEL_CHUNK_EXECUTOR.submit(
+                run_ghostscript_process, input_path, chunk_path, resolution, first_page, last_page, cost, profile
+            )))
+        app.logger.info(f"Compressing {page_count} pages in {len(futures)} parallel chunks")
+        try:
+            for _, future in futures:
+                future.result()
+        except BaseException:
+            # Queued chunks are dropped and running ones finish before the directory goes
+            for _, future in futures:
+                future.cancel()
+            wait_futures([future for _, future in futures])
+            raise
+        merge_pdfs([chunk_path for chunk_path, _ in futures], output_path)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def compress_with_ghostscript(input_path, output_path, resolution, inventory=None):
+    # The Ghostscript engine: large documents go through page-range chunks. inventory
+    # (from analyze_pdf_images) feeds the scheduler's cost estimate and the choice of
+    # GS profile.
+    page_count = None
+    profile = select_gs_profile(input_path, inventory)
+    if PARALLEL_PAGES_THRESHOLD > 0:
+        page_count = get_page_count(input_path, inventory)
+    if page_count and page_count >= PARALLEL_PAGES_THRESHOLD:
+        app.logger.info(f"Running parallel GS with resolution: {resolution} DPI on {os.path.basename(input_path)}")
+        run_ghostscript_parallel(input_path, output_path, resolution, page_count, inventory, profile)
+    else:
+        run_ghostscript(input_path, output_path, resolution, estimate_job_cost(input_path, page_count, inventory), profile)
+    if OPTIMIZE_OUTPUTS:
+        optimize_output(output_path)
+    return True
+
+# --- PDF Image Inventory ---
+# A pikepdf-based pass that lists every raster image a document places: pixel size,
+# highest effective DPI over its placements (that is, at its smallest placement),
+# filter and stream bytes. Page content, nested forms and annotation appearance
+# streams are walked. Ghostscript only downsamples images above
+# GS_DOWNSAMPLE_THRESHOLD x the target DPI, so when no image qualifies (or there are
+# none) a pass cannot shrink anything and is skipped. Rasters can also hide in tiling
+# patterns, Type3 glyphs and soft-mask groups, whose placement is not tracked here, so
+# a document using any of them is treated as unknown. The inventory is cached per
+# content and kind ('original' or 'baseline'). Without pikepdf, for unknown documents
+# or for documents over ANALYZE_MAX_PAGES pages, nothing is skipped. The same walk
+# counts path-painting operators (vector drawing) for the engine selector.
+SKIP_NOOP_PASSES = os.environ.get('SKIP_NOOP_PASSES', '1') == '1'
+ANALYZE_MAX_PAGES = int(os.environ.get('ANALYZE_MAX_PAGES', 1000))
+GS_DOWNSAMPLE_THRESHOLD = 1.5  # Ghostscript's default ColorImageDownsampleThreshold
+PATH_PAINT_OPERATORS = frozenset(('S', 's', 'f', 'F', 'f*', 'B', 'B*', 'b', 'b*'))
+
+def multiply_matrices(m, n):
+    # PDF matrices as [a, b, c, d, e, f]; returns m x n
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return [
+        a * a2 + b * c2, a * b2 + b * d2,
+        c * a2 + d * c2, c * b2 + d * d2,
+        e * a2 + f * c2 + e2, e * b2 + f * d2 + f2
+    ]
+
+def placement_dpi(width, height, ctm):
+    # The image unit square is scaled by the CTM; its drawn size in points gives the DPI
+    drawn_width = (ctm[0] ** 2 + ctm[1] ** 2) ** 0.5 / 72
+    drawn_height = (ctm[2] ** 2 + ctm[3] ** 2) ** 0.5 / 72
+    if drawn_width <= 0 or drawn_height <= 0:
+        return 0
+    return min(width / drawn_width, height / drawn_height)
+
+def stream_filters(obj):
+    filters = obj.get('/Filter')
+    if filters is None:
+        return []
+    if isinstance(filters, pikepdf.Array):
+        return [str(name) for name in filters]
+    return [str(filters)]
+
+class UntrackedImagesError(Exception):
+    pass
+
+def check_untracked_images(resources):
+    # Raises when resources can draw rasters that collect_images does not follow
+    if resources is None:
+        return
+    for pattern in (resources.get('/Pattern') or {}).values():
+        if pattern.get('/PatternType') == 1:
+            raise UntrackedImagesError("tiling pattern")
+    for font in (resources.get('/Font') or {}).values():
+        if font.get('/Subtype') == '/Type3':
+            raise UntrackedImagesError("Type3 font")
+    for state in (resources.get('/ExtGState') or {}).values():
+        if isinstance(state.get('/SMask'), pikepdf.Dictionary):
+            raise UntrackedImagesError("soft-mask group")
+
+def appearance_matrix(annotation, appearance):
+    # Maps the appearance's transformed BBox onto the annotation's Rect (PDF 32000-1, 12.5.5)
+    matrix = [float(value) for value in appearance.get('/Matrix', [1, 0, 0, 1, 0, 0])]
+    x0, y0, x1, y1 = [float(value) for value in appearance.get('/BBox', [0, 0, 0, 0])]
+    corners = [
+        (matrix[0] * x + matrix[2] * y + matrix[4], matrix[1] * x + matrix[3] * y + matrix[5])
+        for x in (x0, x1) for y in (y0, y1)
+    ]
+    left, bottom = min(x for x, _ in corners), min(y for _, y in corners)
+    width, height = max(x for x, _ in corners) - left, max(y for _, y in corners) - bottom
+    rect = [float(value) for value in annotation.get('/Rect', [0, 0, 0, 0])]
+    if width <= 0 or height <= 0:
+        return None
+    scale_x = abs(rect[2] - rect[0]) / width
+    scale_y = abs(rect[3] - rect[1]) / height
+    fit = [scale_x, 0, 0, scale_y, min(rect[0], rect[2]) - left * scale_x, min(rect[1], rect[3]) - bottom * scale_y]
+    return multiply_matrices(matrix, fit)
+
+def collect_annotation_images(page, page_number, images, counts):
+    for annotation in page.obj.get('/Annots') or []:
+        if not isinstance(annotation, pikepdf.Dictionary):
+            continue
+        normal = (annotation.get('/AP') or {}).get('/N')
+        # /N is one appearance stream or a dictionary of them by state
+        appearances = [normal] if isinstance(normal, pikepdf.Stream) else list((normal or {}).values())
+        for appearance in appearances:
+            if not isinstance(appearance, pikepdf.Stream):
+                continue
+            ctm = appearance_matrix(annotation, appearance)
+            if ctm is not None:
+                collect_images(appearance, appearance.get('/Resources'), ctm, page_number, images, set(), counts)
+
+def collect_images(content_owner, resources, ctm, page_number, images, visited, counts):
+    check_untracked_images(resources)
+    stack = []
+    xobjects = resources.get('/XObject') if resources is not None else None
+    for operands, operator in pikepdf.parse_content_stream(content_owner):
+        op = str(operator)
+        if op == 'q':
+            stack.append(ctm)
+        elif op == 'Q':
+            ctm = stack.pop() if stack else ctm
+        elif op == 'cm' and len(operands) == 6:
+            ctm = multiply_matrices([float(value) for value in operands], ctm)
+        elif op in PATH_PAINT_OPERATORS:
+            counts['vector_ops'] += 1
+        elif op == 'Do' and xobjects is not None:
+            xobject = xobjects.get(operands[0])
+            if xobject is None:
+                continue
+            subtype = xobject.get('/Subtype')
+            if subtype == '/Image':
+                key = xobject.objgen
+                width, height = int(xobject.get('/Width', 0)), int(xobject.get('/Height', 0))
+                dpi = placement_dpi(width, height, ctm)
+                record = images.get(key)
+                if record is None:
+                    images[key] = {
+                        'object': list(key), 'page': page_number, 'width': width, 'height': height,
+                        'dpi': round(dpi, 1), 'filter': stream_filters(xobject),
+                        'bits': int(xobject.get('/BitsPerComponent', 1)),
+                        'mask': bool(xobject.get('/ImageMask', False)),
+                        'bytes': int(xobject.get('/Length', 0))
+                    }
+                else:
+                    record['dpi'] = round(max(record['dpi'], dpi), 1)
+            elif subtype == '/Form' and xobject.objgen not in visited:
+                visited.add(xobject.objgen)
+                form_matrix = [float(value) for value in xobject.get('/Matrix', [1, 0, 0, 1, 0, 0])]
+                collect_images(
+                    xobject, xobject.get('/Resources', resources), multiply_matrices(form_matrix, ctm),
+                    page_number, images, visited, counts
+                )
+                visited.discard(xobject.objgen)
+        elif op == 'INLINE IMAGE':
+            inline = operands[0]
+            key = ('inline', page_number, len(images))
+            images[key] = {
+                'object': None, 'page': page_number, 'width': int(inline.width), 'height': int(inline.height),
+                'dpi': round(placement_dpi(int(inline.width), int(inline.height), ctm), 1),
+                'filter': [str(name) for name in inline.filters], 'bits': int(inline.bits_per_component),
+                'mask': bool(inline.image_mask), 'bytes': len(inline.unparse())
+            }
+
+def analyze_pdf_images(path):
+    # Returns {'pages': n, 'images': [...], 'image_bytes': n, 'max_dpi': n, 'vector_ops': n}, or None
+    if pikepdf is None:
+        return None
+    started = time.monotonic()
+    try:
+        with pikepdf.open(path) as pdf:
+            if len(pdf.pages) > ANALYZE_MAX_PAGES:
+                return None
+            images = {}
+            counts = {'vector_ops': 0}
+            for page_number, page in enumerate(pdf.pages, 1):
+                collect_images(page, page.obj.get('/Resources'), [1, 0, 0, 1, 0, 0], page_number, images, set(), counts)
+                collect_annotation_images(page, page_number, images, counts)
+            page_count = len(pdf.pages)
+    except UntrackedImagesError as e:
+        app.logger.info(f"Not analyzing images in {os.path.basename(path)}: it uses a {str(e)}")
+        return None
+    except Exception as e:
+        app.logger.warning(f"Image analysis failed for {os.path.basename(path)}: {str(e)}")
+        return None
+    images = list(images.values())
+    app.logger.info(f"Analyzed {len(images)} images in {os.path.basename(path)} in {time.monotonic() - started:.2f}s")
+    return {
+        'pages': page_count,
+        'images': images,
+        'image_bytes': sum(image['bytes'] for image in images),
+        'max_dpi': max((image['dpi'] for image in images), default=0),
+        'vector_ops': counts['vector_ops']
+    }
+
+def get_image_inventory(digest, path, kind):
+    key = f'images:{kind}'
+    inventory = FILE_CACHE.get_meta(digest, key)
+    if inventory is None:
+        # Failures are cached too, so an unparseable document is only tried once
+        inventory = analyze_pdf_images(path) or {'unavailable': True}
+        FILE_CACHE.set_meta(digest, key, inventory)
+    return None if inventory.get('unavailable') else inventory
+
+def pass_can_shrink_images(inventory, resolution):
+    # Unknown documents are always compressed
+    if not SKIP_NOOP_PASSES or inventory is None:
+        return True
+    return inventory['max_dpi'] > resolution * GS_DOWNSAMPLE_THRESHOLD
+
+# --- Lossless Post-Pass ---
+# With OPTIMIZE_OUTPUTS=1, every Ghostscript result gets a structural pass that loses
+# nothing: identical image and embedded font streams are merged into one object,
+# Flate streams are recompressed at the highest level, objects are packed into object
+# streams with a compressed xref (which lifts the output to PDF 1.5). It uses pikepdf,
+# or the qpdf CLI without deduplication when pikepdf is missing. The result replaces
+# the Ghostscript output only when it is smaller. Stage timings are logged per file
+# and totalled under /metrics. Streamed responses skip the pass.
+OPTIMIZE_OUTPUTS = os.environ.get('OPTIMIZE_OUTPUTS', '0') == '1'
+OPTIMIZE_MAX_PASSES = 4  # Merging masks can make their images identical, so dedup repeats
+FONT_FILE_KEYS = ('/FontFile', '/FontFile2', '/FontFile3')
+
+class OptimizeStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.kept = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.merged_streams = 0
+        self.stage_seconds = {}
+
+    def record(self, size_in, size_out, merged, stages):
+        with self.lock:
+            self.count += 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            self.merged_streams += merged
+            if size_out < size_in:
+                self.kept += 1
+            for stage, seconds in stages.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "enabled": OPTIMIZE_OUTPUTS,
+                "engine": 'pikepdf' if pikepdf is not None else 'qpdf',
+                "count": self.count,
+                "kept": self.kept,
+                "failed": self.failed,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "merged_streams": self.merged_streams,
+                "mean_stage_ms": {
+                    stage: round(seconds / self.count * 1000, 3) for stage, seconds in self.stage_seconds.items()
+                } if self.count else {}
+            }
+
+OPTIMIZE_STATS = OptimizeStats()
+
+def stream_identity(stream):
+    # Raw (still encoded) bytes plus the dictionary without /Length, with references
+    # as "n g R", so streams only match when they decode and render the same way
+    attributes = pikepdf.Dictionary({key: value for key, value in stream.stream_dict.items() if key != '/Length'})
+    return hashlib.sha256(stream.read_raw_bytes()).hexdigest(), attributes.unparse()
+
+def replace_references(obj, remap):
+    # Points references to merged streams at the kept copy; recurses into direct objects only
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+        items = list(obj.items())
+    elif isinstance(obj, pikepdf.Array):
+        items = list(enumerate(obj))
+    else:
+        return
+    for key, value in items:
+        if not isinstance(value, (pikepdf.Dictionary, pikepdf.Stream, pikepdf.Array)):
+            continue
+        if value.is_indirect:
+            if value.objgen in remap:
+                obj[key] = remap[value.objgen]
+        else:
+            replace_references(value, remap)
+
+def dedupe_streams(pdf):
+    # Returns the number of image/font streams merged into an identical earlier one
+    merged_away = set()  # Stay in pdf.objects until saved, so they are skipped
+    for _ in range(OPTIMIZE_MAX_PASSES):
+        font_files = set()
+        for obj in pdf.objects:
+            if isinstance(obj, pikepdf.Dictionary) and obj.get('/Type') == '/FontDescriptor':
+                for key in FONT_FILE_KEYS:
+                    if key in obj and obj[key].is_indirect:
+                        font_files.add(obj[key].objgen)
+        kept = {}
+        remap = {}
+        for obj in pdf.objects:
+            if not isinstance(obj, pikepdf.Stream) or obj.objgen in merged_away:
+                continue
+            if obj.get('/Subtype') != '/Image' and obj.objgen not in font_files:
+                continue
+            identity = stream_identity(obj)
+            if identity in kept:
+                remap[obj.objgen] = kept[identity]
+            else:
+                kept[identity] = obj
+        if not remap:
+            break
+        for obj in pdf.objects:
+            replace_references(obj, remap)
+        replace_references(pdf.trailer, remap)
+        merged_away.update(remap)
+    return len(merged_away)
+
+def optimize_with_pikepdf(input_path, output_path, stages):
+    started = time.perf_counter()
+    with pikepdf.open(input_path) as pdf:
+        stages['open'] = time.perf_counter() - started
+        started = time.perf_counter()
+        merged = dedupe_streams(pdf)
+        stages['dedupe'] = time.perf_counter() - started
+        started = time.perf_counter()
+        # Unreferenced (merged) objects are not written
+        pdf.save(
+            output_path, compress_streams=True, recompress_flate=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate
+        )
+        stages['save'] = time.perf_counter() - started
+    return merged
+
+def optimize_with_qpdf(input_path, output_path, stages):
+    started = time.perf_counter()
+    run_process([
+        'qpdf', '--object-streams=generate', '--recompress-flate', '--compression-level=9',
+        input_path, output_path
+    ], timeout=GS_TIMEOUT_SECONDS)
+    stages['qpdf'] = time.perf_counter() - started
+    return 0
+
+def optimize_output(path):
+    # Rewrites path in place when the optimized file is smaller; never raises
+    if pikepdf is None and not shutil.which('qpdf'):
+        return
+    size_in = file_size(path)
+    optimized_path = SCRATCH.path('.pdf', size_hint=size_in)
+    stages = {}
+    try:
+        with GS_LIMITER.slot(estimate_job_cost(path)):
+            if pikepdf is not None:
+                merged = optimize_with_pikepdf(path, optimized_path, stages)
+            else:
+                merged = optimize_with_qpdf(path, optimized_path, stages)
+        size_out = file_size(optimized_path)
+        if 0 < size_out < size_in:
+            shutil.move(optimized_path, path)
+        OPTIMIZE_STATS.record(size_in, min(size_out, size_in) if size_out else size_in, merged, stages)
+        app.logger.info(
+            f"Optimized {os.path.basename(path)}: {size_in} -> {size_out} bytes, {merged} streams merged ("
+            + ', '.join(f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in stages.items()) + ")"
+        )
+    except Exception as e:
+        OPTIMIZE_STATS.record_failure()
+        app.logger.warning(f"Lossless pass failed for {os.path.basename(path)}, keeping the Ghostscript output: {str(e)}")
+    finally:
+        if os.path.exists(optimized_path):
+            os.remove(optimized_path)
+
+# --- Image Re-encoding Engine ---
+# An alternative to Ghostscript for image-heavy documents: pikepdf opens the PDF, every
+# 8-bit gray/RGB image placed above the target DPI (by the same threshold Ghostscript
+# uses) is resampled to it in a process pool (image_worker.py, Pillow + NumPy), then
+# re-encoded and written back in place; everything else is left untouched. JPEG
+# sources stay JPEG (decoded at a reduced scale by libjpeg), others become Flate unless
+# REENCODE_FORMAT=jpeg; gray-looking RGB becomes gray. A re-encoded stream is only used
+# when it is smaller. Documents without an image inventory, or with any image above
+# the target DPI that this engine cannot resample (CMYK, indexed, 1-bit, /Decode,
+# color-key masks, JBIG2, CCITT, JPX) or fails to decode, are declined and go to
+# Ghostscript whole, so no image is ever left at full resolution. A worker crash
+# (segfault, OOM kill) breaks the process pool; it is then replaced and the images are
+# tried once more.
+REENCODE_AVAILABLE = pikepdf is not None and image_worker is not None
+REENCODE_WORKERS = int(os.environ.get('REENCODE_WORKERS', GS_PROCESS_SHARE))
+REENCODE_FORMAT = os.environ.get('REENCODE_FORMAT', 'auto')  # 'auto' or 'jpeg'
+REENCODE_JPEG_QUALITY = int(os.environ.get('REENCODE_JPEG_QUALITY', 75))
+REENCODE_GRAY_TOLERANCE = int(os.environ.get('REENCODE_GRAY_TOLERANCE', 4))
+REENCODE_POOL = None
+REENCODE_POOL_LOCK = threading.Lock()
+
+def get_reencode_pool():
+    # forkserver: forking a threaded server process is unsafe, and workers only need
+    # image_worker, not this module
+    global REENCODE_POOL
+    with REENCODE_POOL_LOCK:
+        if REENCODE_POOL is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['image_worker'])
+            REENCODE_POOL = ProcessPoolExecutor(max_workers=REENCODE_WORKERS, mp_context=context)
+            atexit.register(REENCODE_POOL.shutdown)
+        return REENCODE_POOL
+
+def reset_reencode_pool(pool):
+    global REENCODE_POOL
+    with REENCODE_POOL_LOCK:
+        if REENCODE_POOL is pool:
+            REENCODE_POOL = None
+    pool.shutdown(wait=False)
+
+def resample_images(jobs, input_path):
+    # Returns {objgen: worker result}, or None when an image could not be resampled
+    for attempt in range(2):
+        pool = get_reencode_pool()
+        futures = {}
+        try:
+            for objgen, (_, job) in jobs.items():
+                futures[objgen] = pool.submit(image_worker.resample_image, job)
+            results = {}
+            for objgen, future in futures.items():
+                try:
+                    results[objgen] = future.result(timeout=GS_TIMEOUT_SECONDS)
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    # Pillow reports bad data in many ways (OSError, SyntaxError, DecompressionBombError, ...)
+                    app.logger.warning(f"Could not re-encode image {objgen} of {os.path.basename(input_path)}: {str(e)}")
+                    for pending in futures.values():
+                        pending.cancel()
+                    return None
+            return results
+        except BrokenProcessPool:
+            reset_reencode_pool(pool)
+            if attempt:
+                raise
+            app.logger.warning(f"Re-encoding workers died on {os.path.basename(input_path)}, restarting the pool")
+
+def image_mode(image):
+    # Returns 'RGB' or 'L' for images the engine can resample, else None
+    if image.get('/ImageMask', False) or int(image.get('/BitsPerComponent', 0)) != 8 or '/Decode' in image:
+        return None
+    # A color-key /Mask names exact sample values; lossy or gray re-encoding would
+    # shift them and paint the masked-out pixels
+    if isinstance(image.get('/Mask'), pikepdf.Array):
+        return None
+    color_space = image.get('/ColorSpace')
+    if isinstance(color_space, pikepdf.Array) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        components = int(color_space[1].get('/N', 0))
+        return {1: 'L', 3: 'RGB'}.get(components)
+    return {'/DeviceGray': 'L', '/DeviceRGB': 'RGB'}.get(str(color_space) if color_space is not None else None)
+
+def reencode_job(image, mode, scale):
+    filters = stream_filters(image)
+    width, height = int(image['/Width']), int(image['/Height'])
+    job = {
+        'mode': mode, 'width': width, 'height': height,
+        'target_width': max(1, round(width * scale)), 'target_height': max(1, round(height * scale)),
+        'quality': REENCODE_JPEG_QUALITY, 'gray_tolerance': REENCODE_GRAY_TOLERANCE
+    }
+    if filters == ['/DCTDecode']:
+        job.update(kind='jpeg', source=image.read_raw_bytes(), encode='jpeg')
+    elif all(name in ('/FlateDecode', '/LZWDecode', '/RunLengthDecode') for name in filters):
+        source = image.read_bytes()
+        if len(source) < width * height * len(mode):
+            return None
+        job.update(kind='raw', source=source, encode='jpeg' if REENCODE_FORMAT == 'jpeg' else 'flate')
+    else:
+        return None
+    return job
+
+def reencode_pdf(input_path, output_path, resolution, inventory=None):
+    # Returns False when the document is not one for this engine (an image it cannot resample)
+    if not REENCODE_AVAILABLE:
+        return False
+    if inventory is None:
+        inventory = analyze_pdf_images(input_path)
+    if inventory is None:
+        return False
+    oversampled = [image for image in inventory['images'] if image['dpi'] > resolution * GS_DOWNSAMPLE_THRESHOLD]
+    if any(not image['object'] for image in oversampled):
+        # Inline images cannot be rewritten in place
+        return False
+    targets = {tuple(image['object']): resolution / image['dpi'] for image in oversampled}
+    stages = {}
+    started = time.perf_counter()
+    with GS_LIMITER.slot(estimate_job_cost(input_path, None, inventory)), pikepdf.open(input_path) as pdf:
+        jobs = {}
+        for objgen, scale in targets.items():
+            image = pdf.get_object(objgen)
+            mode = image_mode(image)
+            job = reencode_job(image, mode, scale) if mode else None
+            if job is None:
+                app.logger.info(f"Image {objgen} of {os.path.basename(input_path)} needs Ghostscript, declining")
+                return False
+            jobs[objgen] = (image, job)
+            # Soft masks are drawn with their image, so they get the same scale
+            mask = image.get('/SMask')
+            if isinstance(mask, pikepdf.Stream) and mask.is_indirect and mask.objgen not in jobs and image_mode(mask) == 'L':
+                mask_job = reencode_job(mask, 'L', scale)
+                if mask_job is not None:
+                    mask_job['encode'] = 'flate'
+                    jobs[mask.objgen] = (mask, mask_job)
+        stages['extract'] = time.perf_counter() - started
+        if not jobs:
+            return False
+
+        started = time.perf_counter()
+        results = resample_images(jobs, input_path)
+        if results is None:
+            return False
+        bytes_before = bytes_after = replaced = 0
+        for objgen, result in results.items():
+            image, job = jobs[objgen]
+            original_bytes = len(image.read_raw_bytes())
+            if len(result['data']) >= original_bytes:
+                continue
+            image.write(result['data'], filter=pikepdf.Name(result['filter']))
+            if '/DecodeParms' in image:
+                del image['/DecodeParms']
+            image.Width, image.Height, image.BitsPerComponent = result['width'], result['height'], 8
+            if result['mode'] != job['mode']:
+                image.ColorSpace = pikepdf.Name.DeviceGray
+            bytes_before += original_bytes
+            bytes_after += len(result['data'])
+            replaced += 1
+        stages['resample'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pdf.save(output_path, compress_streams=True)
+        stages['save'] = time.perf_counter() - started
+    app.logger.info(
+        f"Re-encoded {replaced}/{len(jobs)} images of {os.path.basename(input_path)} at {resolution} DPI: "
+        f"{bytes_before} -> {bytes_after} bytes ("
+        + ', '.join(f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in stages.items()) + ")"
+    )
+    return True
+
+# --- Compression Engines ---
+# Every compression pass goes through compress_pdf, which hands the document to one of
+# the registered engines:
+#   ghostscript - full pdfwrite rewrite, downsampling every image (the default path)
+#   pikepdf     - lossless structural rewrite only: merged duplicate streams, object
+#                 streams, recompressed Flate (qpdf when pikepdf is not installed)
+#   reencode    - resamples raster images in place and leaves everything else alone
+# An engine returns False to decline a document, which then goes to Ghostscript.
+# COMPRESSION_ENGINE defaults to ghostscript. With COMPRESSION_ENGINE=auto (opt-in)
+# select_engine picks one per document from what the image inventory already knows:
+# only when no image is above the downsample threshold is the lossless rewrite enough,
+# since anything else would leave the requested DPI unmet; scans (images over
+# SCAN_IMAGE_RATIO of the file and fewer than ENGINE_VECTOR_OPS_PER_PAGE path operators
+# per page) are re-encoded; everything else, and anything without an inventory, gets
+# Ghostscript. Passes that SKIP_NOOP_PASSES would skip (no image above the threshold)
+# still go through compress_pdf in auto mode, so those are the ones that get the
+# lossless rewrite instead of a plain copy of their source.
+# The engine that produced an output and its time are kept with the content, returned
+# in X-Compression-Engine / X-Compression-Seconds (and the JSON of /compress-initial),
+# and totalled per engine under /metrics.
+ENGINES = {}
+COMPRESSION_ENGINE = os.environ.get('COMPRESSION_ENGINE', 'ghostscript')
+ENGINE_VECTOR_OPS_PER_PAGE = int(os.environ.get('ENGINE_VECTOR_OPS_PER_PAGE', 500))
+
+def register_engine(name):
+    def register(function):
+        ENGINES[name] = function
+        return function
+    return register
+
+@register_engine('ghostscript')
+def ghostscript_engine(input_path, output_path, resolution, inventory=None):
+    return compress_with_ghostscript(input_path, output_path, resolution, inventory)
+
+@register_engine('pikepdf')
+def lossless_engine(input_path, output_path, resolution, inventory=None):
+    if pikepdf is None and not shutil.which('qpdf'):
+        return False
+    with GS_LIMITER.slot(estimate_job_cost(input_path, None, inventory)):
+        if pikepdf is not None:
+            optimize_with_pikepdf(input_path, output_path, {})
+        else:
+            optimize_with_qpdf(input_path, output_path, {})
+    if file_size(output_path) >= file_size(input_path):
+        shutil.copyfile(input_path, output_path)
+    return True
+
+@register_engine('reencode')
+def reencode_engine(input_path, output_path, resolution, inventory=None):
+    if not reencode_pdf(input_path, output_path, resolution, inventory):
+        return False
+    if OPTIMIZE_OUTPUTS:
+        optimize_output(output_path)
+    return True
+
+ENGINE_CHOICES = tuple(ENGINES) + ('auto',)
+if COMPRESSION_ENGINE not in ENGINE_CHOICES:
+    raise ValueError(f"Unknown COMPRESSION_ENGINE: {COMPRESSION_ENGINE}")
+
+class EngineStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {name: {"runs": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "declined": 0} for name in ENGINES}
+        self.selected = {name: 0 for name in ENGINES}
+
+    def record(self, name, seconds, size_in, size_out):
+        with self.lock:
+            stats = self.engines[name]
+            stats["runs"] += 1
+            stats["seconds"] += seconds
+            stats["bytes_in"] += size_in
+            stats["bytes_out"] += size_out
+
+    def record_declined(self, name):
+        with self.lock:
+            self.engines[name]["declined"] += 1
+
+    def record_selected(self, name):
+        with self.lock:
+            self.selected[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "default": COMPRESSION_ENGINE,
+                "selected": dict(self.selected),
+                "engines": {
+                    name: {
+                        "runs": stats["runs"],
+                        "declined": stats["declined"],
+                        "mean_seconds": round(stats["seconds"] / stats["runs"], 3) if stats["runs"] else None,
+                        "bytes_saved": stats["bytes_in"] - stats["bytes_out"]
+                    }
+                    for name, stats in self.engines.items()
+                }
+            }
+
+ENGINE_STATS = EngineStats()
+SKIPPED_RUN = {'engine': 'none', 'seconds': 0.0}  # The pass could not shrink anything and was skipped
+
+def select_engine(input_path, inventory, resolution):
+    if inventory is None:
+        return 'ghostscript'
+    if inventory['max_dpi'] <= resolution * GS_DOWNSAMPLE_THRESHOLD:
+        return 'pikepdf'
+    image_ratio = inventory['image_bytes'] / max(1, file_size(input_path))
+    vectors_per_page = inventory['vector_ops'] / max(1, inventory['pages'])
+    if image_ratio >= SCAN_IMAGE_RATIO and vectors_per_page < ENGINE_VECTOR_OPS_PER_PAGE and REENCODE_AVAILABLE:
+        return 'reencode'
+    return 'ghostscript'
+
+def rewrites_noop_passes(engine=None):
+    # True when a pass without images to downsample is still compressed (losslessly)
+    return (engine or COMPRESSION_ENGINE) == 'auto' and (pikepdf is not None or shutil.which('qpdf') is not None)
+
+def resolve_engine(engine, input_path, inventory, resolution):
+    engine = engine or COMPRESSION_ENGINE
+    if engine != 'auto':
+        return engine
+    engine = select_engine(input_path, inventory, resolution)
+    ENGINE_STATS.record_selected(engine)
+    return engine
+
+def compress_pdf(input_path, output_path, resolution, inventory=None, engine=None):
+    # Entry point for every compression pass. engine defaults to COMPRESSION_ENGINE.
+    # Returns {'engine': name, 'seconds': n} for the engine that produced the output.
+    engine = resolve_engine(engine, input_path, inventory, resolution)
+    started = time.monotonic()
+    try:
+        handled = ENGINES[engine](input_path, output_path, resolution, inventory)
+    except Exception as e:
+        if engine == 'ghostscript':
+            raise
+        app.logger.warning(f"{engine} engine failed on {os.path.basename(input_path)}, using Ghostscript: {str(e)}")
+        handled = False
+    if not handled:
+        ENGINE_STATS.record_declined(engine)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        engine = 'ghostscript'
+        started = time.monotonic()
+        compress_with_ghostscript(input_path, output_path, resolution, inventory)
+    seconds = time.monotonic() - started
+    ENGINE_STATS.record(engine, seconds, file_size(input_path), file_size(output_path))
+    app.logger.info(f"{engine} engine compressed {os.path.basename(input_path)} at {resolution} DPI in {seconds:.2f}s")
+    return {'engine': engine, 'seconds': round(seconds, 3)}
+
+def engine_headers(response, run):
+    # run is what compress_pdf returned, or None when unknown
+    if run:
+        response.headers['X-Compression-Engine'] = run['engine']
+        response.headers['X-Compression-Seconds'] = str(run['seconds'])
+    return response
 
 # --- NEW: Initial Compression Route ---
 @app.route('/compress-initial', methods=['POST'])
@@ -52,44 +2032,602 @@ def compress_initial():
         return jsonify({"error": "No PDF file part"}), 400
     
     pdf_file = request.files['pdf']
-    
-    # Create a temporary file to hold the original upload
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_original:
-        pdf_file.stream.seek(0)
-        temp_original.write(pdf_file.stream.read())
-        original_path = temp_original.name
-
-    # Create a path for the high-quality baseline file
-    baseline_path = tempfile.mktemp(suffix=".pdf")
-    file_id = str(uuid.uuid4())
-
     try:
-        # Create the high-quality (300 DPI) baseline for future adjustments
-        baseline_resolution = 300
-        run_ghostscript(original_path, baseline_path, baseline_resolution)
-
-        # Store the baseline file path in our cache
-        TEMP_FILE_CACHE[file_id] = {'path': baseline_path, 'timestamp': time.time()}
-        app.logger.info(f"Created baseline file for ID {file_id} at {baseline_path}")
+        original_path, digest = save_upload(pdf_file)
+    except UploadTooLargeError as e:
+        return jsonify({"error": str(e)}), 413
+    except OSError as e:
+        app.logger.error(f"Could not store upload: {str(e)}")
+        return jsonify({"error": "Failed to store the uploaded file."}), 507
 
-        # Read the data to send back to the user for the first response
-        with open(baseline_path, 'rb') as f:
-            compressed_data = f.read()
+    # Job mode: answer right away and let the background executor run Ghostscript
+    async_mode = request.args.get('async', request.form.get('async', '0')).lower() in ('1', 'true', 'yes')
+    if async_mode:
+        try:
+            GS_LIMITER.admit()
+        except QueueFullError:
+            os.remove(original_path)
+            raise
+        try:
+            job_id = submit_compression_job(original_path, digest)
+        except BaseException:
+            # The job never started, so it will not release the admission
+            GS_LIMITER.release_admission()
+            if os.path.exists(original_path):
+                os.remove(original_path)
+            raise
+        return jsonify({
+            "message": "accepted",
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}"
+        }), 202
 
+    file_id = str(uuid.uuid4())
+    try:
+        baseline_path = create_baseline(file_id, digest, original_path, admit=True)
+        run = FILE_CACHE.get_meta(digest, 'engine:baseline') or {}
         return jsonify({
             "message": "success",
             "file_id": file_id,
-            "size": len(compressed_data)
+            "size": os.path.getsize(baseline_path),
+            "engine": run.get('engine'),
+            "engine_seconds": run.get('seconds')
         })
-
+    except QueueFullError:
+        raise
     except Exception as e:
         app.logger.error(f"Error in initial compression: {str(e)}", exc_info=True)
         return jsonify({"error": "Failed to create initial compressed file."}), 500
+
+# --- Streaming Upload Handling ---
+# File parts are written straight into scratch space while Werkzeug parses the request
+# body (instead of its spooled /tmp file, which would then be copied over), hashed on
+# the way, so peak memory per request stays at one chunk regardless of the document
+# size. Write errors are held until save_upload claims the file, where the routes
+# handle them. Uploads nobody claims are removed when the request closes.
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 250 * 1024 * 1024))
+# Let Werkzeug reject oversized bodies before parsing (allowing for multipart overhead)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + UPLOAD_CHUNK_SIZE
+
+class UploadTooLargeError(Exception):
+    pass
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes"}), 413
+
+class ScratchUpload:
+    # A writable upload file in scratch space: it starts in the RAM tier (when there is
+    # room) and spills to disk once it outgrows the RAM file limit or the tier fills
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.error = None
+        self.claimed = False
+        self.path = SCRATCH.path('.pdf', size_hint=0)
+        self.file = open(self.path, 'w+b')
+
+    def write(self, chunk):
+        if self.error is None:
+            try:
+                self._append(chunk)
+            except (UploadTooLargeError, OSError) as e:
+                self.error = e
+                self._discard()
+        return len(chunk)
+
+    def _append(self, chunk):
+        written = self.size
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise UploadTooLargeError(f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+        self.hasher.update(chunk)
+        if SCRATCH.should_spill(self.path, self.size):
+            self.file.close()
+            self.path = SCRATCH.spill(self.path)
+            self.file = open(self.path, 'a+b')
+        try:
+            # Flushed per chunk so a full tmpfs is noticed on the chunk that hit it
+            self.file.write(chunk)
+            self.file.flush()
+        except OSError as e:
+            if e.errno != errno.ENOSPC or not SCRATCH.in_ram(self.path):
+                raise
+            with contextlib.suppress(OSError):
+                self.file.close()
+            os.truncate(self.path, written)
+            self.path = SCRATCH.spill(self.path)
+            self.file = open(self.path, 'a+b')
+            self.file.write(chunk)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence) if not self.file.closed else 0
+
+    def read(self, size=-1):
+        return self.file.read(size) if not self.file.closed else b''
+
+    def readline(self, size=-1):
+        return self.file.readline(size) if not self.file.closed else b''
+
+    def _discard(self):
+        with contextlib.suppress(OSError):
+            self.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def claim(self):
+        # Hands the finished file over; returns (path, sha256 hex digest)
+        if self.error is not None:
+            raise self.error
+        self.file.close()
+        self.claimed = True
+        return self.path, self.hasher.hexdigest()
+
+    def close(self):
+        if not self.claimed:
+            self._discard()
+
+class ScratchRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scratch_uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = ScratchUpload()
+        self.scratch_uploads.append(upload)
+        return upload
+
+    def close(self):
+        # Also covers uploads from a body whose parsing failed halfway
+        super().close()
+        for upload in self.scratch_uploads:
+            upload.close()
+
+app.request_class = ScratchRequest
+
+def save_upload(pdf_file):
+    # Returns (path, digest) of the upload in scratch space, which the caller now owns
+    upload = pdf_file.stream
+    if not isinstance(upload, ScratchUpload):
+        # Uploads parsed elsewhere (the ASGI app) are copied over in chunks
+        upload = ScratchUpload()
+        try:
+            pdf_file.stream.seek(0)
+            while upload.error is None:
+                chunk = pdf_file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload.write(chunk)
+        except BaseException:
+            upload.close()
+            raise
+    return upload.claim()
+
+def create_baseline(file_id, digest, original_path, on_progress=None, admit=False):
+    # Builds (or reuses) the 300 DPI baseline for an upload and registers file_id for it.
+    # The original upload is removed unless it is kept as a source artifact. Returns the
+    # baseline path.
+    try:
+        baseline_path = reuse_baseline(file_id, digest, original_path)
+        if baseline_path:
+            return baseline_path
+
+        # Create a path for the high-quality baseline file
+        baseline_path = SCRATCH.path('.pdf', size_hint=file_size(original_path))
+        if on_progress:
+            on_progress('compressing', 0.2)
+
+        try:
+            # Create the high-quality (300 DPI) baseline for future adjustments.
+            # If no image is above the downsampling threshold, the upload is the baseline.
+            baseline_resolution = BASELINE_RESOLUTION
+            original_images = analyze_pdf_images(original_path)
+            if pass_can_shrink_images(original_images, baseline_resolution) or rewrites_noop_passes():
+                with GS_LIMITER.admission() if admit else contextlib.nullcontext():
+                    run = compress_pdf(original_path, baseline_path, baseline_resolution, original_images)
+                baseline_images = None
+            else:
+                app.logger.info(f"No images above {baseline_resolution} DPI in upload for ID {file_id}, skipping Ghostscript")
+                shutil.move(original_path, baseline_path)
+                baseline_images = original_images
+                run = SKIPPED_RUN
+        except Exception:
+            if os.path.exists(baseline_path):
+                os.remove(baseline_path)
+            raise
+
+        return register_baseline(file_id, digest, original_path, baseline_path, original_images, baseline_images, run)
     finally:
         # Clean up the original uploaded temp file
         if os.path.exists(original_path):
             os.remove(original_path)
 
+def reuse_baseline(file_id, digest, original_path):
+    # Identical uploads reuse the existing baseline under a new file_id. Returns its
+    # path, or None when this content has no baseline yet.
+    baseline_path = FILE_CACHE.attach_file_id(file_id, digest)
+    if baseline_path:
+        app.logger.info(f"Reusing baseline of {digest[:12]} for ID {file_id}, skipping Ghostscript")
+        # Put the upload back if it is needed and was evicted
+        original_images = FILE_CACHE.get_meta(digest, 'images:original')
+        if original_images and original_images.get('unavailable'):
+            original_images = None
+        if original_needed(original_images) and not get_cached_output(digest, ORIGINAL_RESOLUTION):
+            keep_original(digest, original_path)
+    return baseline_path
+
+def register_baseline(file_id, digest, original_path, baseline_path, original_images, baseline_images, run=None):
+    # Store the baseline file path in our cache. If an identical upload finished
+    # first, its baseline wins and ours is dropped. Returns the registered path.
+    stored_path = FILE_CACHE.add_content(digest, baseline_path, file_id)
+    if stored_path != baseline_path:
+        os.remove(baseline_path)
+        baseline_path = stored_path
+    elif run is not None:
+        FILE_CACHE.set_meta(digest, 'engine:baseline', run)
+    if original_images is not None:
+        FILE_CACHE.set_meta(digest, 'images:original', original_images)
+    if baseline_images is not None:
+        FILE_CACHE.set_meta(digest, 'images:baseline', baseline_images)
+    elif original_needed(original_images):
+        keep_original(digest, original_path)
+    enforce_cache_budget(keep_path=baseline_path)
+    app.logger.info(f"Created baseline file for ID {file_id} at {baseline_path}")
+
+    if PRECOMPUTE_QUALITY_LADDER:
+        schedule_quality_ladder(digest, baseline_path)
+    return baseline_path
+
+# --- Source Artifact Selection ---
+# Every adjusted output is derived from the baseline, or from the original upload for
+# DPIs above the baseline's when it was kept. Outputs are never derived from other
+# outputs: JPEG losses would stack across generations, and the bytes of a quality level
+# would depend on which outputs happened to be cached first. The upload is only kept when the baseline pass actually downsampled something (or when that is
+# unknown), since only then can DPIs above the baseline's be more detailed than it.
+# It is stored as the output at ORIGINAL_RESOLUTION, so the LRU budget covers it too.
+# KEEP_ORIGINAL_UPLOADS: 'auto' (default), 'always' or 'never'.
+BASELINE_RESOLUTION = 300
+ORIGINAL_RESOLUTION = 0  # Stands for "not downsampled"
+KEEP_ORIGINAL_UPLOADS = os.environ.get('KEEP_ORIGINAL_UPLOADS', 'auto')
+
+def original_needed(original_images):
+    if KEEP_ORIGINAL_UPLOADS in ('always', 'never'):
+        return KEEP_ORIGINAL_UPLOADS == 'always'
+    return original_images is None or original_images['max_dpi'] > BASELINE_RESOLUTION * GS_DOWNSAMPLE_THRESHOLD
+
+def keep_original(digest, original_path):
+    if not os.path.exists(original_path):
+        return
+    # The cache owns the file from here on, so move it out of the way of the caller's cleanup
+    # It is rarely read again, so it goes to the disk tier
+    kept_path = SCRATCH.path('.pdf')
+    shutil.move(original_path, kept_path)
+    stored, replaced_path = FILE_CACHE.set_output(digest, ORIGINAL_RESOLUTION, kept_path)
+    if replaced_path and os.path.exists(replaced_path):
+        os.remove(replaced_path)
+    if not stored:
+        os.remove(kept_path)
+        return
+    app.logger.info(f"Kept original upload of {digest[:12]} as a source artifact")
+
+def select_source(digest, baseline_path, resolution):
+    # Returns (path, kind) of the artifact the output at resolution is derived from
+    if resolution > BASELINE_RESOLUTION:
+        original = FILE_CACHE.list_outputs(digest).get(ORIGINAL_RESOLUTION)
+        if original and os.path.exists(original[0]):
+            return original[0], 'original'
+    return baseline_path, 'baseline'
+
+# --- Asynchronous Compression Jobs ---
+# /compress-initial?async=1 returns a job id immediately; the baseline is built by
+# COMPRESS_JOB_EXECUTOR and /jobs/<job_id> reports state, progress and the final size.
+# Job records live in the cache backend so any worker can answer the status poll.
+COMPRESS_JOB_WORKERS = int(os.environ.get('COMPRESS_JOB_WORKERS', 2))
+COMPRESS_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=COMPRESS_JOB_WORKERS, thread_name_prefix='compress-job')
+
+def update_compression_job(job_id, **fields):
+    FILE_CACHE.update_job(job_id, **fields)
+
+def submit_compression_job(original_path, digest):
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    FILE_CACHE.save_job(job_id, {
+        'state': 'queued', 'stage': 'queued', 'progress': 0.0,
+        'file_id': None, 'size': None, 'engine': None, 'error': None,
+        'created': now, 'updated': now
+    })
+    app.logger.info(f"Queued compression job {job_id}")
+    # Submitted last: once the job is queued, it owns the admission and the upload
+    COMPRESS_JOB_EXECUTOR.submit(run_compression_job, job_id, original_path, digest)
+    return job_id
+
+def run_compression_job(job_id, original_path, digest):
+    file_id = str(uuid.uuid4())
+    update_compression_job(job_id, state='running', stage='starting', progress=0.1)
+    try:
+        baseline_path = create_baseline(
+            file_id, digest, original_path,
+            on_progress=lambda stage, progress: update_compression_job(job_id, stage=stage, progress=progress)
+        )
+        run = FILE_CACHE.get_meta(digest, 'engine:baseline') or {}
+        update_compression_job(
+            job_id, state='done', stage='done', progress=1.0,
+            file_id=file_id, size=os.path.getsize(baseline_path), engine=run.get('engine')
+        )
+    except Exception as e:
+        app.logger.error(f"Error in compression job {job_id}: {str(e)}", exc_info=True)
+        update_compression_job(job_id, state='failed', stage='failed', error="Failed to create initial compressed file.")
+    finally:
+        # Admitted when the job was submitted
+        GS_LIMITER.release_admission()
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def compression_job_status(job_id):
+    job = FILE_CACHE.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Invalid or expired job ID."}), 404
+    return jsonify({
+        "job_id": job_id,
+        "state": job['state'],
+        "stage": job['stage'],
+        "progress": job['progress'],
+        "file_id": job['file_id'],
+        "size": job['size'],
+        "engine": job.get('engine'),
+        "error": job['error'],
+        "elapsed_seconds": round(job['updated'] - job['created'], 3)
+    })
+
+# --- Adjusted Output Builders ---
+def build_adjusted_output(digest, baseline_path, resolution):
+    # Compresses the best source artifact and stores the result in the file cache.
+    # Returns (path, cached); an uncached path belongs to the caller.
+    adjusted_path, run = compress_from_source(digest, baseline_path, resolution)
+    FILE_CACHE.set_meta(digest, f'engine:{resolution}', run)
+    return adjusted_path, store_adjusted_output(digest, resolution, adjusted_path)
+
+def compress_from_source(digest, baseline_path, resolution, engine=None):
+    # Returns (path, run) for a new, unstored output at resolution
+    source_path, source_kind = select_source(digest, baseline_path, resolution)
+    adjusted_path = SCRATCH.path('.pdf', size_hint=file_size(source_path))
+    try:
+        # A pass that cannot downsample any image would only rewrite its source
+        inventory = get_image_inventory(digest, source_path, source_kind)
+        if pass_can_shrink_images(inventory, resolution) or rewrites_noop_passes(engine):
+            app.logger.info(f"Deriving {resolution} DPI for {digest[:12]} from the {source_kind} artifact")
+            run = compress_pdf(source_path, adjusted_path, resolution, inventory, engine=engine)
+        else:
+            app.logger.info(f"No images above {resolution} DPI in the {source_kind} of {digest[:12]}, reusing it")
+            link_or_copy(source_path, adjusted_path)
+            run = SKIPPED_RUN
+    except Exception:
+        if os.path.exists(adjusted_path):
+            os.remove(adjusted_path)
+        raise
+    return adjusted_path, run
+
+def store_adjusted_output(digest, resolution, adjusted_path):
+    # If the content expired while GS was running, the output is not cached
+    cached, previous_path = FILE_CACHE.set_output(digest, resolution, adjusted_path)
+    if previous_path and os.path.exists(previous_path):
+        os.remove(previous_path)
+    if cached:
+        enforce_cache_budget(keep_path=adjusted_path)
+    return cached
+
+def link_or_copy(source_path, target_path):
+    # target_path may be the empty placeholder of a RAM reservation
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+def get_cached_output(digest, resolution):
+    path = FILE_CACHE.get_output(digest, resolution)
+    return path if path and os.path.exists(path) else None
+
+def precompute_output(digest, baseline_path, resolution):
+    try:
+        if get_cached_output(digest, resolution):
+            return # Another worker process built it already
+        adjusted_path, cached = build_adjusted_output(digest, baseline_path, resolution)
+        if not cached and os.path.exists(adjusted_path):
+            os.remove(adjusted_path)
+    except Exception as e:
+        app.logger.error(f"Error precomputing {resolution} DPI for {digest[:12]}: {str(e)}")
+        raise
+    finally:
+        with PENDING_OUTPUTS_LOCK:
+            PENDING_OUTPUTS.pop((digest, resolution), None)
+
+def schedule_quality_ladder(digest, baseline_path):
+    # Start with the slider stops closest to the default quality (7 -> 300 DPI)
+    qualities = sorted(DPI_MAP, key=lambda quality: abs(quality - 7))
+    with PENDING_OUTPUTS_LOCK:
+        for quality in qualities:
+            key = (digest, DPI_MAP[quality])
+            if key in PENDING_OUTPUTS or get_cached_output(*key):
+                continue
+            PENDING_OUTPUTS[key] = PRECOMPUTE_EXECUTOR.submit(precompute_output, digest, baseline_path, key[1])
+    app.logger.info(f"Scheduled quality ladder precomputation for {digest[:12]}")
+
+def get_or_build_output(digest, baseline_path, resolution, admit=False):
+    # Returns (path, cached) for an adjusted output, reusing a cached file or a build
+    # already in flight when there is one. An uncached path belongs to the caller.
+    key = (digest, resolution)
+    while True:
+        cached_path = get_cached_output(digest, resolution)
+        if cached_path:
+            return cached_path, True
+
+        # Single flight: the first request for a (content, DPI) registers a future and
+        # does the work; identical concurrent requests (double clicks, several tabs,
+        # precomputation) wait on it and share the cached result. A precomputation
+        # that has not started yet is cancelled and the work is done right here.
+        with PENDING_OUTPUTS_LOCK:
+            pending_job = PENDING_OUTPUTS.get(key)
+            if pending_job is not None and pending_job.cancel():
+                pending_job = None
+            if pending_job is None:
+                if admit:
+                    GS_LIMITER.admit()
+                leader_job = Future()
+                leader_job.set_running_or_notify_cancel()
+                PENDING_OUTPUTS[key] = leader_job
+                break
+
+        app.logger.info(f"Waiting on in-flight build of {resolution} DPI for {digest[:12]}")
+        try:
+            pending_job.result(timeout=GS_TIMEOUT_SECONDS)
+        except Exception:
+            pass # Loop and run GS ourselves unless someone else has started
+        cached_path = get_cached_output(digest, resolution)
+        if cached_path:
+            return cached_path, True
+        # An uncached result belongs to the request that built it, so build our own
+        with PENDING_OUTPUTS_LOCK:
+            if PENDING_OUTPUTS.get(key) is pending_job:
+                del PENDING_OUTPUTS[key]
+
+    try:
+        # Run GS on the best source with the new resolution and cache the output
+        result = build_adjusted_output(digest, baseline_path, resolution)
+    except BaseException as e:
+        leader_job.set_exception(e)
+        raise
+    else:
+        leader_job.set_result(result[1])
+        return result
+    finally:
+        with PENDING_OUTPUTS_LOCK:
+            if PENDING_OUTPUTS.get(key) is leader_job:
+                del PENDING_OUTPUTS[key]
+        if admit:
+            GS_LIMITER.release_admission()
+
+def send_adjusted_file(path, resolution):
+    return send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f'compressed-{resolution}dpi.pdf'
+    )
+
+# --- Streaming Ghostscript Output ---
+# With "stream": true in the request (or STREAM_GS_OUTPUT=1 as the default), an output
+# that is not cached yet is produced by a one-shot `gs` writing to stdout and the bytes
+# are sent to the client as they arrive, instead of after the whole file is written.
+# Interpreter messages go to stderr (-sstdout=%stderr) so they never mix with the PDF.
+# The stream is teed into a file that is cached once gs exits cleanly, and the build is
+# registered as in flight so identical requests wait for it. A failure after the first
+# byte aborts the connection (WSGI has no trailers), so the client sees a truncated
+# transfer rather than a broken PDF with a 200. Passes that would be skipped or split
+# into page-range chunks use the regular path.
+STREAM_GS_OUTPUT = os.environ.get('STREAM_GS_OUTPUT', '0') == '1'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def stream_ghostscript(input_path, resolution, tee_path, cost, outcome, profile=None):
+    command = pdfwrite_command('-', resolution, profile) + ['-sstdout=%stderr', input_path]
+    with GS_LIMITER.slot(cost), tempfile.TemporaryFile() as errors, open(tee_path, 'wb') as tee:
+        process = spawn_process(command, stdout=subprocess.PIPE, stderr=errors)
+        timer = threading.Timer(GS_TIMEOUT_SECONDS, process.kill)
+        timer.start()
+        try:
+            while True:
+                chunk = os.read(process.stdout.fileno(), STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                tee.write(chunk)
+                yield chunk
+            returncode = process.wait()
+        except BaseException:
+            # Includes GeneratorExit when the client disconnects
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            timer.cancel()
+            process.stdout.close()
+        if returncode != 0:
+            errors.seek(0)
+            error = subprocess.CalledProcessError(returncode, command, stderr=errors.read()[-4096:])
+            app.logger.error(f"Streaming GS failed for {os.path.basename(input_path)}, aborting response: {str(error)}")
+            outcome['error'] = error
+            raise error
+    outcome['done'] = True
+
+def finish_streamed_output(digest, resolution, leader_job, tee_path, outcome):
+    try:
+        if outcome.get('done'):
+            # Timed until the last byte left, which is when Ghostscript finished writing
+            seconds = time.monotonic() - outcome['started']
+            ENGINE_STATS.record('ghostscript', seconds, outcome['size_in'], file_size(tee_path))
+            FILE_CACHE.set_meta(digest, f'engine:{resolution}', {'engine': 'ghostscript', 'seconds': round(seconds, 3)})
+            cached = store_adjusted_output(digest, resolution, tee_path)
+            if not cached and os.path.exists(tee_path):
+                os.remove(tee_path)
+            leader_job.set_result(cached)
+        else:
+            if tee_path and os.path.exists(tee_path):
+                os.remove(tee_path)
+            leader_job.set_exception(outcome.get('error') or RuntimeError("Streaming response was not completed"))
+    finally:
+        with PENDING_OUTPUTS_LOCK:
+            if PENDING_OUTPUTS.get((digest, resolution)) is leader_job:
+                del PENDING_OUTPUTS[(digest, resolution)]
+        GS_LIMITER.release_admission()
+
+def stream_adjusted_output(digest, baseline_path, resolution):
+    # Returns a streaming response, or None when the regular path should handle the request
+    if get_cached_output(digest, resolution):
+        return None
+    source_path, source_kind = select_source(digest, baseline_path, resolution)
+    inventory = get_image_inventory(digest, source_path, source_kind)
+    if not pass_can_shrink_images(inventory, resolution):
+        return None
+    engine = select_engine(source_path, inventory, resolution) if COMPRESSION_ENGINE == 'auto' else COMPRESSION_ENGINE
+    if engine != 'ghostscript':
+        return None
+    page_count = get_page_count(source_path, inventory) if PARALLEL_PAGES_THRESHOLD > 0 else None
+    if page_count and page_count >= PARALLEL_PAGES_THRESHOLD:
+        return None
+
+    key = (digest, resolution)
+    with PENDING_OUTPUTS_LOCK:
+        pending_job = PENDING_OUTPUTS.get(key)
+        if pending_job is not None and not pending_job.cancel():
+            return None
+        GS_LIMITER.admit()
+        leader_job = Future()
+        leader_job.set_running_or_notify_cancel()
+        PENDING_OUTPUTS[key] = leader_job
+
+    tee_path = None
+    outcome = {}
+    try:
+        if COMPRESSION_ENGINE == 'auto':
+            ENGINE_STATS.record_selected(engine)
+        app.logger.info(f"Streaming {resolution} DPI for {digest[:12]} from the {source_kind} artifact")
+        tee_path = SCRATCH.path('.pdf', size_hint=file_size(source_path))
+        cost = estimate_job_cost(source_path, page_count, inventory)
+        profile = select_gs_profile(source_path, inventory)
+        response = Response(stream_ghostscript(source_path, resolution, tee_path, cost, outcome, profile), mimetype='application/pdf')
+        response.headers['Content-Disposition'] = f'attachment; filename=compressed-{resolution}dpi.pdf'
+        response.headers['X-Compression-Streamed'] = '1'
+        response.headers['X-Compression-Engine'] = engine
+        outcome['started'] = time.monotonic()
+        outcome['size_in'] = file_size(source_path)
+        response.call_on_close(functools.partial(finish_streamed_output, digest, resolution, leader_job, tee_path, outcome))
+    except BaseException as e:
+        # No response will be closed, so release the admission and the leader entry here
+        outcome['error'] = e
+        finish_streamed_output(digest, resolution, leader_job, tee_path, outcome)
+        raise
+    return response
+
 # --- NEW: Adjustment and Download Route ---
 @app.route('/adjust-and-download', methods=['POST'])
 def adjust_and_download():
@@ -98,53 +2636,585 @@ def adjust_and_download():
     quality_value = data.get('quality', '7') # Default to 300 DPI
     app.logger.info(f"--- Received request for /adjust-and-download for ID {file_id} ---")
 
-    if not file_id or file_id not in TEMP_FILE_CACHE:
+    resolution = get_gs_resolution(quality_value)
+    digest, baseline_path = FILE_CACHE.lookup(file_id) if file_id else (None, None)
+    if baseline_path is None:
         return jsonify({"error": "Invalid or expired file ID."}), 404
 
-    baseline_path = TEMP_FILE_CACHE[file_id]['path']
-    resolution = get_gs_resolution(quality_value)
-    adjusted_path = tempfile.mktemp(suffix=".pdf")
+    adjusted_path = None
+    cached = False
+    stream = data.get('stream', STREAM_GS_OUTPUT)
+    if isinstance(stream, str):
+        stream = stream.lower() in ('1', 'true', 'yes')
+    engine = data.get('engine') or COMPRESSION_ENGINE
+    if engine not in ENGINE_CHOICES:
+        return jsonify({"error": f"Unknown engine. Use one of: {', '.join(ENGINE_CHOICES)}."}), 400
 
     try:
-        # Run GS on the baseline file with the new resolution
-        run_ghostscript(baseline_path, adjusted_path, resolution)
-
-        return send_file(
-            adjusted_path,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f'compressed-{resolution}dpi.pdf'
-        )
+        if engine != COMPRESSION_ENGINE:
+            # The cache holds default-engine outputs only, so this is built just for us
+            with GS_LIMITER.admission():
+                adjusted_path, run = compress_from_source(digest, baseline_path, resolution, engine=engine)
+            return engine_headers(send_adjusted_file(adjusted_path, resolution), run)
+        if stream:
+            response = stream_adjusted_output(digest, baseline_path, resolution)
+            if response is not None:
+                return response
+        adjusted_path, cached = get_or_build_output(digest, baseline_path, resolution, admit=True)
+        run = FILE_CACHE.get_meta(digest, f'engine:{resolution}')
+        return engine_headers(send_adjusted_file(adjusted_path, resolution), run)
+    except QueueFullError:
+        raise
     except Exception as e:
         app.logger.error(f"Error in adjustment compression: {str(e)}", exc_info=True)
         return jsonify({"error": "Failed to adjust file."}), 500
     finally:
-        # The adjusted file is sent, so we can clean it up
-        if os.path.exists(adjusted_path):
+        # Uncached outputs are sent, so we can clean them up
+        if adjusted_path and not cached and os.path.exists(adjusted_path):
             os.remove(adjusted_path)
 
+# --- Target-Size Compression Route ---
+# Finds the highest DPI whose output fits under target_bytes. The quality ladder is
+# tried first (all stops in parallel); then TARGET_SEARCH_STEPS DPIs between the best
+# fitting stop and the next one up are tried in parallel. Every candidate ends up in
+# the output cache, so later slider moves and searches reuse them.
+TARGET_SEARCH_STEPS = int(os.environ.get('TARGET_SEARCH_STEPS', 4))
+TARGET_SEARCH_WORKERS = int(os.environ.get('TARGET_SEARCH_WORKERS', max(1, GS_MAX_CONCURRENCY)))
+TARGET_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=TARGET_SEARCH_WORKERS, thread_name_prefix='target-search')
+
+def evaluate_resolutions(digest, baseline_path, resolutions, uncached_paths):
+    # Builds the given DPIs in parallel; returns {dpi: (path, size)} for those that succeeded
+    futures = {
+        resolution: TARGET_SEARCH_EXECUTOR.submit(get_or_build_output, digest, baseline_path, resolution)
+        for resolution in resolutions
+    }
+    results = {}
+    for resolution, future in futures.items():
+        try:
+            path, cached = future.result()
+        except Exception as e:
+            app.logger.warning(f"Target-size candidate {resolution} DPI failed: {str(e)}")
+            continue
+        if not cached:
+            uncached_paths.append(path)
+        results[resolution] = (path, os.path.getsize(path))
+    return results
+
+@app.route('/compress-to-size', methods=['POST'])
+def compress_to_size():
+    data = request.get_json() or {}
+    file_id = data.get('file_id')
+    app.logger.info(f"--- Received request for /compress-to-size for ID {file_id} ---")
+    try:
+        target_bytes = int(data.get('target_bytes'))
+    except (ValueError, TypeError):
+        return jsonify({"error": "target_bytes must be a positive integer."}), 400
+    if target_bytes <= 0:
+        return jsonify({"error": "target_bytes must be a positive integer."}), 400
+
+    digest, baseline_path = FILE_CACHE.lookup(file_id) if file_id else (None, None)
+    if baseline_path is None:
+        return jsonify({"error": "Invalid or expired file ID."}), 404
+
+    uncached_paths = []
+    chosen_path = None
+    try:
+        with GS_LIMITER.admission():
+            ladder = sorted(set(DPI_MAP.values()))
+            candidates = evaluate_resolutions(digest, baseline_path, ladder, uncached_paths)
+            if not candidates:
+                return jsonify({"error": "Failed to compress file."}), 500
+
+            fitting = [resolution for resolution, (_, size) in candidates.items() if size <= target_bytes]
+            if not fitting:
+                smallest = min(candidates, key=lambda resolution: candidates[resolution][1])
+                return jsonify({
+                    "error": "No quality level fits the target size.",
+                    "target_bytes": target_bytes,
+                    "smallest_size": candidates[smallest][1],
+                    "smallest_dpi": smallest
+                }), 422
+
+            # Refine between the best fitting stop and the next stop up
+            best = max(fitting)
+            higher = [resolution for resolution in ladder if resolution > best]
+            if higher and TARGET_SEARCH_STEPS > 0:
+                upper = higher[0]
+                step = (upper - best) / (TARGET_SEARCH_STEPS + 1)
+                between = sorted({round(best + step * i) for i in range(1, TARGET_SEARCH_STEPS + 1)} - {best, upper})
+                refined = evaluate_resolutions(digest, baseline_path, between, uncached_paths)
+                candidates.update(refined)
+                best = max(resolution for resolution, (_, size) in candidates.items() if size <= target_bytes)
+
+        chosen_path, chosen_size = candidates[best]
+        app.logger.info(f"Target {target_bytes} bytes for ID {file_id}: chose {best} DPI ({chosen_size} bytes)")
+        response = send_adjusted_file(chosen_path, best)
+        response.headers['X-Compression-DPI'] = str(best)
+        response.headers['X-Compression-Size'] = str(chosen_size)
+        return engine_headers(response, FILE_CACHE.get_meta(digest, f'engine:{best}'))
+    except QueueFullError:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error in target-size compression: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to compress file."}), 500
+    finally:
+        # Candidates that could not be cached are dropped once the response holds its file
+        remove_files(uncached_paths)
+
+# --- Output Size Estimation Route ---
+# Predicts the output size of every slider stop without full passes. Each stop is
+# estimated from the artifact select_source would derive it from (the baseline, or the
+# kept original for DPIs above the baseline's).
+# ESTIMATE_SAMPLE_PAGES pages spread through that artifact are copied into a small
+# sample PDF, which is compressed once per DPI; each sampled page's bytes in that
+# output relative to its bytes in the sample give a ratio, and the mean ratio times the
+# artifact's size is the estimate. The spread of the ratios gives the error bounds
+# (about two standard errors, with a finite-population correction). Stops where no
+# image would be downsampled are copies of their source, and stops derived from the
+# baseline at or above its DPI are rewrites of it at its own DPI, so neither is
+# sampled. The sampled ratios are cached per content and artifact; stops that already
+# have a full output report its exact size.
+ESTIMATE_SAMPLE_PAGES = max(1, int(os.environ.get('ESTIMATE_SAMPLE_PAGES', 4)))
+ESTIMATE_WORKERS = int(os.environ.get('ESTIMATE_WORKERS', max(2, GS_MAX_CONCURRENCY)))
+ESTIMATE_EXECUTOR = ThreadPoolExecutor(max_workers=ESTIMATE_WORKERS, thread_name_prefix='estimate')
+
+def choose_sample_pages(page_count):
+    if not page_count:
+        return list(range(1, ESTIMATE_SAMPLE_PAGES + 1))
+    if page_count <= ESTIMATE_SAMPLE_PAGES:
+        return list(range(1, page_count + 1))
+    # Evenly spaced, centred in each stretch of the document
+    stride = page_count / ESTIMATE_SAMPLE_PAGES
+    return sorted({int(stride * i + stride / 2) + 1 for i in range(ESTIMATE_SAMPLE_PAGES)})
+
+def extract_sample_pages(input_path, pages, sample_path):
+    # Copies the pages into sample_path unchanged; returns the pages that exist
+    if pikepdf is not None:
+        with pikepdf.open(input_path) as pdf, pikepdf.new() as sample:
+            pages = [page for page in pages if page <= len(pdf.pages)]
+            for page in pages:
+                sample.pages.append(pdf.pages[page - 1])
+            sample.save(sample_path)
+        return pages
+    page_count = get_page_count(input_path)
+    pages = [page for page in pages if not page_count or page <= page_count]
+    run_process(
+        ['qpdf', '--empty', '--pages', input_path, ','.join(str(page) for page in pages), '--', sample_path],
+        timeout=GS_TIMEOUT_SECONDS
+    )
+    return pages
+
+def reachable_streams(obj, found, visited):
+    # Collects {objgen: raw length} for the streams under obj, not following /Parent
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        if obj.objgen in visited:
+            return
+        visited.add(obj.objgen)
+    if isinstance(obj, pikepdf.Stream):
+        found[obj.objgen] = len(obj.read_raw_bytes())
+        obj = obj.stream_dict
+    if isinstance(obj, pikepdf.Dictionary):
+        for key, value in obj.items():
+            if key != '/Parent':
+                reachable_streams(value, found, visited)
+    elif isinstance(obj, pikepdf.Array):
+        for value in obj:
+            reachable_streams(value, found, visited)
+
+def page_sizes(path):
+    # Stream bytes each page accounts for (shared streams are split evenly between
+    # the pages using them), or the whole file as one "page" without pikepdf
+    if pikepdf is None:
+        return [file_size(path)]
+    with pikepdf.open(path) as pdf:
+        users = {}
+        lengths = {}
+        for index, page in enumerate(pdf.pages):
+            found = {}
+            reachable_streams(page.obj, found, set())
+            for objgen, length in found.items():
+                lengths[objgen] = length
+                users.setdefault(objgen, []).append(index)
+        sizes = [0.0] * len(pdf.pages)
+        for objgen, indexes in users.items():
+            for index in indexes:
+                sizes[index] += lengths[objgen] / len(indexes)
+    return sizes
+
+def compress_sample(sample_path, resolution, sample_dir, cost):
+    output_path = os.path.join(sample_dir, f'{resolution}.pdf')
+    run_ghostscript_process(sample_path, output_path, resolution, cost=cost)
+    return page_sizes(output_path)
+
+def sample_size_ratios(source_path, resolutions, page_count):
+    # Returns (pages, {dpi: [ratio per sampled page]}); a DPI whose pass failed is left out
+    sample_dir = SCRATCH.directory('estimate', size_hint=0)
+    try:
+        sample_path = os.path.join(sample_dir, 'sample.pdf')
+        pages = extract_sample_pages(source_path, choose_sample_pages(page_count), sample_path)
+        reference = page_sizes(sample_path)
+        cost = estimate_job_cost(sample_path)
+        futures = {
+            resolution: ESTIMATE_EXECUTOR.submit(compress_sample, sample_path, resolution, sample_dir, cost)
+            for resolution in resolutions
+        }
+        ratios = {}
+        for resolution, future in futures.items():
+            try:
+                sizes = future.result()
+            except Exception as e:
+                app.logger.warning(f"Size sample at {resolution} DPI failed: {str(e)}")
+                continue
+            ratios[resolution] = [size / reference_size for size, reference_size in zip(sizes, reference) if reference_size]
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+    return pages, ratios
+
+def get_size_samples(digest, source_path, source_kind, resolutions, page_count):
+    # Ratios are cached per content and source artifact; only missing DPIs are sampled
+    key = f'size_samples:{source_kind}'
+    samples = FILE_CACHE.get_meta(digest, key) or {'pages': [], 'ratios': {}}
+    missing = [resolution for resolution in resolutions if str(resolution) not in samples['ratios']]
+    if missing:
+        started = time.monotonic()
+        pages, ratios = sample_size_ratios(source_path, missing, page_count)
+        samples['pages'] = pages
+        samples['ratios'].update({str(resolution): values for resolution, values in ratios.items()})
+        FILE_CACHE.set_meta(digest, key, samples)
+        app.logger.info(f"Sampled {len(pages)} pages of the {source_kind} at {len(missing)} DPIs in {time.monotonic() - started:.2f}s")
+    return samples
+
+def estimate_from_ratios(ratios, source_size, page_count):
+    count = len(ratios)
+    mean = sum(ratios) / count
+    if count > 1:
+        variance = sum((ratio - mean) ** 2 for ratio in ratios) / (count - 1)
+        correction = max(0.0, 1 - count / page_count) if page_count else 1.0
+        margin = 2 * (variance / count * correction) ** 0.5
+    else:
+        margin = mean * 0.5 if not page_count or page_count > 1 else 0.0 # one page says little about the rest
+    return (
+        round(source_size * mean),
+        round(source_size * max(0.0, mean - margin)),
+        round(source_size * (mean + margin))
+    )
+
+@app.route('/estimate-sizes', methods=['POST'])
+def estimate_sizes():
+    data = request.get_json() or {}
+    file_id = data.get('file_id')
+    app.logger.info(f"--- Received request for /estimate-sizes for ID {file_id} ---")
+
+    digest, baseline_path = FILE_CACHE.lookup(file_id) if file_id else (None, None)
+    if baseline_path is None:
+        return jsonify({"error": "Invalid or expired file ID."}), 404
+
+    try:
+        page_count = get_page_count(baseline_path, get_image_inventory(digest, baseline_path, 'baseline'))
+        # Uncached stops grouped by the artifact they would be derived from
+        sources = {}
+        cached_sizes = {}
+        for resolution in sorted(set(DPI_MAP.values())):
+            cached_path = get_cached_output(digest, resolution)
+            if cached_path:
+                cached_sizes[resolution] = os.path.getsize(cached_path)
+            else:
+                sources.setdefault(select_source(digest, baseline_path, resolution), []).append(resolution)
+
+        stops = {}
+        sample_pages = []
+        for (source_path, source_kind), resolutions in sources.items():
+            source_size = os.path.getsize(source_path)
+            inventory = get_image_inventory(digest, source_path, source_kind)
+            sampled = [
+                resolution for resolution in resolutions
+                if pass_can_shrink_images(inventory, resolution)
+                and not (source_kind == 'baseline' and resolution >= BASELINE_RESOLUTION)
+            ]
+            ratios = {}
+            if sampled:
+                with GS_LIMITER.admission():
+                    samples = get_size_samples(digest, source_path, source_kind, sampled, page_count)
+                ratios = samples['ratios']
+                sample_pages = sample_pages or samples['pages']
+            for resolution in resolutions:
+                if resolution not in sampled:
+                    # A copy of the source, or a rewrite of the baseline at its own DPI
+                    exact = not pass_can_shrink_images(inventory, resolution) and not rewrites_noop_passes()
+                    stops[resolution] = {"size": source_size, "low": source_size, "high": source_size, "exact": exact}
+                elif ratios.get(str(resolution)):
+                    size, low, high = estimate_from_ratios(ratios[str(resolution)], source_size, page_count)
+                    stops[resolution] = {"size": size, "low": low, "high": high, "exact": False}
+                else:
+                    stops[resolution] = {"size": None, "low": None, "high": None, "exact": False}
+        for resolution, size in cached_sizes.items():
+            stops[resolution] = {"size": size, "low": size, "high": size, "exact": True}
+
+        estimates = [dict(stops[resolution], quality=quality, dpi=resolution) for quality, resolution in sorted(DPI_MAP.items())]
+        return jsonify({
+            "file_id": file_id,
+            "page_count": page_count,
+            "sample_pages": sample_pages,
+            "estimates": estimates
+        })
+    except QueueFullError:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error estimating sizes: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to estimate sizes."}), 500
+
+# --- Batch Compression Route ---
+# POST /compress-batch takes many files under the 'pdfs' field plus a quality level and
+# answers with a ZIP that is streamed while the documents are being compressed: each
+# entry is written as soon as its file finishes (so entries are in completion order)
+# and a manifest.json with per-file sizes or errors comes last. Entries are stored
+# uncompressed since the PDFs already are, and the archive goes out through a write
+# buffer that is drained after every chunk, so neither the ZIP nor any output is held
+# in memory. The upload side is not streamed: the multipart body is parsed (Werkzeug
+# spools large parts to temporary files) and every file is saved to scratch before the
+# first ZIP byte goes out. Each document goes through the same baseline and output
+# caches as the single-file routes; the whole batch takes one admission ticket.
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 500))
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', GS_MAX_CONCURRENCY * 2))
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+class ZipStreamWriter:
+    # Write-only, unseekable file object: zipfile falls back to data descriptors
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def batch_entry_name(filename, used_names):
+    name = os.path.basename((filename or '').replace('\\', '/')) or 'document.pdf'
+    stem, extension = os.path.splitext(name)
+    if extension.lower() != '.pdf':
+        stem, extension = name, '.pdf'
+    candidate = stem + extension
+    counter = 2
+    while candidate in used_names:
+        candidate = f'{stem} ({counter}){extension}'
+        counter += 1
+    used_names.add(candidate)
+    return candidate
+
+def compress_batch_file(original_path, digest, resolution):
+    # Returns (path, cached) like get_or_build_output; an uncached path belongs to the caller
+    baseline_path = create_baseline(str(uuid.uuid4()), digest, original_path)
+    return get_or_build_output(digest, baseline_path, resolution)
+
+def discard_batch_result(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    path, cached = future.result()
+    if not cached and os.path.exists(path):
+        os.remove(path)
+
+def close_batch(futures, consumed, originals):
+    # Runs when the response is closed, even if the client left before the end (or
+    # before the first byte): drop queued work and clean up after running work. A
+    # cancelled file never reaches create_baseline, which would remove its upload.
+    for future in futures:
+        if future in consumed:
+            continue
+        if future.cancel():
+            remove_files([originals[future]])
+        else:
+            future.add_done_callback(discard_batch_result)
+    GS_LIMITER.release_admission()
+
+def stream_batch_zip(futures, consumed, resolution):
+    stream = ZipStreamWriter()
+    manifest = []
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for future in as_completed(futures):
+            consumed.add(future)
+            name = futures[future]
+            try:
+                path, cached = future.result()
+            except Exception as e:
+                app.logger.error(f"Error compressing {name} in batch: {str(e)}", exc_info=True)
+                manifest.append({"name": name, "error": "Failed to compress file."})
+                continue
+            try:
+                entry = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                entry.compress_type = zipfile.ZIP_STORED
+                with open(path, 'rb') as source, archive.open(entry, 'w') as target:
+                    while True:
+                        chunk = source.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield stream.drain()
+                manifest.append({"name": name, "size": entry.file_size, "dpi": resolution})
+            finally:
+                if not cached and os.path.exists(path):
+                    os.remove(path)
+            yield stream.drain()
+        archive.writestr('manifest.json', json.dumps({"dpi": resolution, "files": manifest}, indent=2))
+    yield stream.drain()
+    app.logger.info(f"Batch of {len(futures)} files at {resolution} DPI streamed")
+
+@app.route('/compress-batch', methods=['POST'])
+def compress_batch():
+    app.logger.info("--- Received request for /compress-batch ---")
+    # A batch may be far larger than a single upload; each file is still capped
+    request.max_content_length = BATCH_MAX_BYTES
+    pdf_files = [pdf_file for pdf_file in request.files.getlist('pdfs') if pdf_file.filename]
+    if not pdf_files:
+        return jsonify({"error": "No PDF files in the 'pdfs' field."}), 400
+    if len(pdf_files) > BATCH_MAX_FILES:
+        return jsonify({"error": f"A batch can hold at most {BATCH_MAX_FILES} files."}), 400
+    resolution = get_gs_resolution(request.form.get('quality', '7'))
+
+    GS_LIMITER.admit()
+    uploads = []
+    try:
+        used_names = set()
+        for pdf_file in pdf_files:
+            original_path, digest = save_upload(pdf_file)
+            uploads.append((batch_entry_name(pdf_file.filename, used_names), original_path, digest))
+    except BaseException as e:
+        remove_files([original_path for _, original_path, _ in uploads])
+        GS_LIMITER.release_admission()
+        if isinstance(e, UploadTooLargeError):
+            return jsonify({"error": str(e)}), 413
+        if isinstance(e, OSError):
+            app.logger.error(f"Could not store batch upload: {str(e)}")
+            return jsonify({"error": "Failed to store the uploaded files."}), 507
+        raise
+
+    futures = {}
+    originals = {}
+    for name, original_path, digest in uploads:
+        future = BATCH_EXECUTOR.submit(compress_batch_file, original_path, digest, resolution)
+        futures[future] = name
+        originals[future] = original_path
+    app.logger.info(f"Compressing a batch of {len(futures)} files at {resolution} DPI")
+    consumed = set()
+    response = Response(stream_batch_zip(futures, consumed, resolution), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="compressed-{resolution}dpi.zip"'
+    response.call_on_close(functools.partial(close_batch, futures, consumed, originals))
+    return response
+
+# --- GS Profile Tuning Command ---
+# flask --app app tune-gs <corpus dir> [--profiles a,b] [--dpi 150] [--repeat 2]
+# Compresses every PDF under the corpus with each candidate profile (one-shot gs, best
+# of --repeat runs), sums the times per document class and writes the fastest profile
+# for each class, with all timings and output sizes, to GS_TUNING_PATH. Workers pick
+# the result up when they start.
+@app.cli.command('tune-gs')
+@click.argument('corpus', type=click.Path(exists=True, file_okay=False))
+@click.option('--profiles', default=None, help='Comma-separated profile names (default: all).')
+@click.option('--dpi', 'resolution', default=150, show_default=True, type=int, help='Target resolution of the benchmark passes.')
+@click.option('--repeat', default=2, show_default=True, type=int, help='Runs per document and profile; the fastest counts.')
+@click.option('--output', default=None, help='Where to write the results (default: GS_TUNING_PATH).')
+def tune_gs(corpus, profiles, resolution, repeat, output):
+    names = profiles.split(',') if profiles else sorted(GS_PROFILES)
+    unknown = [name for name in names if name not in GS_PROFILES]
+    if unknown:
+        raise click.BadParameter(f"unknown profiles: {', '.join(unknown)}", param_hint='--profiles')
+    documents = sorted(
+        os.path.join(directory, name)
+        for directory, _, file_names in os.walk(corpus)
+        for name in file_names if name.lower().endswith('.pdf')
+    )
+    if not documents:
+        raise click.ClickException(f"No PDF files under {corpus}")
+
+    results = {}  # {document class: {'documents', 'seconds': {profile: total}, 'bytes': {...}, 'failed': [...]}}
+    output_dir = SCRATCH.directory('tune')
+    try:
+        for path in documents:
+            document = document_class(path, analyze_pdf_images(path))
+            entry = results.setdefault(document, {
+                'documents': 0, 'seconds': dict.fromkeys(names, 0.0), 'bytes': dict.fromkeys(names, 0), 'failed': []
+            })
+            entry['documents'] += 1
+            timings = {}
+            for name in names:
+                if name in entry['failed']:
+                    continue
+                output_path = os.path.join(output_dir, f'{name}.pdf')
+                try:
+                    runs = []
+                    for _ in range(max(1, repeat)):
+                        started = time.perf_counter()
+                        run_process(pdfwrite_command(output_path, resolution, name) + [path], timeout=GS_TIMEOUT_SECONDS)
+                        runs.append(time.perf_counter() - started)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                    # A profile that breaks on one document of a class is out for the class
+                    click.echo(f"  {name} failed on {path}: {str(e)}", err=True)
+                    entry['failed'].append(name)
+                    continue
+                timings[name] = min(runs)
+                entry['seconds'][name] += timings[name]
+                entry['bytes'][name] += file_size(output_path)
+            click.echo(f"{os.path.relpath(path, corpus)} [{document}]: " + ', '.join(
+                f'{name} {seconds:.2f}s' for name, seconds in sorted(timings.items(), key=lambda item: item[1])
+            ))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    classes = {}
+    for document, entry in sorted(results.items()):
+        candidates = {name: seconds for name, seconds in entry['seconds'].items() if name not in entry['failed']}
+        if not candidates:
+            continue
+        best = min(candidates, key=candidates.get)
+        classes[document] = {
+            'profile': best,
+            'documents': entry['documents'],
+            'seconds': {name: round(seconds, 3) for name, seconds in candidates.items()},
+            'bytes': {name: entry['bytes'][name] for name in candidates},
+            'failed': entry['failed']
+        }
+        click.echo(f"{document}: {best} ({candidates[best]:.2f}s over {entry['documents']} documents)")
+
+    output = output or GS_TUNING_PATH
+    tuning = {
+        'generated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'resolution': resolution,
+        'repeat': repeat,
+        'cpu_limit': CPU_LIMIT,
+        'classes': classes
+    }
+    temp_path = f'{output}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(tuning, f, indent=2)
+    os.replace(temp_path, output)
+    click.echo(f"Wrote {output}; restart the workers to use it")
+
 # --- NEW: Cache Cleanup ---
 def cleanup_expired_files():
     while True:
         time.sleep(600) # Check every 10 minutes
-        now = time.time()
-        expired_ids = [
-            file_id for file_id, data in TEMP_FILE_CACHE.items()
-            if now - data['timestamp'] > CACHE_EXPIRATION_SECONDS
-        ]
-        if expired_ids:
-            app.logger.info(f"Cleaning up {len(expired_ids)} expired files.")
-            for file_id in expired_ids:
-                file_path = TEMP_FILE_CACHE[file_id]['path']
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                del TEMP_FILE_CACHE[file_id]
+        try:
+            expired_paths = FILE_CACHE.expire(CACHE_EXPIRATION_SECONDS)
+        except Exception as e:
+            app.logger.error(f"Error expiring cache entries: {str(e)}")
+            continue
+        if expired_paths:
+            app.logger.info(f"Cleaning up {len(expired_paths)} expired files.")
+            remove_files(expired_paths)
+
+# Started at import so every gunicorn worker runs it; the backends make concurrent
+# sweeps safe because each expired file is handed to exactly one caller.
+cleanup_thread = threading.Thread(target=cleanup_expired_files, daemon=True)
+cleanup_thread.start()
 
 # --- Main entry point for the app ---
 if __name__ == '__main__':
-    # Start the cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_expired_files, daemon=True)
-    cleanup_thread.start()
-    
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,336 @@
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+import os
+import subprocess
+import uuid
+import time
+import shutil
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import app as core
+
+# --- Basic Configuration ---
+# asyncio variant of the core routes, served with an ASGI server, e.g.
+#   uvicorn asgi_app:app --host 0.0.0.0 --port 10000 --workers $WEB_CONCURRENCY
+# Uploads and downloads are handled on the event loop, Ghostscript and qpdf run through
+# asyncio.create_subprocess_exec, and blocking helpers of the core app (the SQLite file
+# cache, pikepdf analysis, hashing uploads to disk) run in the default thread pool.
+# Anything that waits for a GS_LIMITER slot (the slot itself, in-process engines, the
+# lossless post-pass) runs on SLOT_EXECUTOR instead, so a deep Ghostscript queue never
+# holds the default pool's threads and cache lookups and downloads keep moving. The
+# cache, admission limiter and scheduler are the core app's, so both variants can share
+# CACHE_DB_PATH. Only `/`, `/compress-initial` and `/adjust-and-download` are served;
+# job mode and streaming are specific to the WSGI app.
+app = Quart(__name__)
+app = cors(app, allow_origin='*')
+app.config['MAX_CONTENT_LENGTH'] = core.app.config['MAX_CONTENT_LENGTH']
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+SLOT_WAIT_THREADS = int(os.environ.get('ASGI_SLOT_WAIT_THREADS', max(32, (core.GS_MAX_CONCURRENCY + core.GS_MAX_QUEUE) * 4)))
+SLOT_EXECUTOR = ThreadPoolExecutor(max_workers=SLOT_WAIT_THREADS, thread_name_prefix='gs-slot')
+
+async def in_slot_thread(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(SLOT_EXECUTOR, functools.partial(function, *args))
+
+@app.errorhandler(413)
+async def upload_too_large(e):
+    return jsonify({"error": f"Upload exceeds {core.MAX_UPLOAD_BYTES} bytes"}), 413
+
+@app.errorhandler(core.QueueFullError)
+async def compression_queue_full(e):
+    response = jsonify({"error": "Server is busy, please retry later.", "retry_after": e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+# --- Health Check Route ---
+@app.route('/', methods=['GET'])
+async def health_check():
+    return jsonify({"status": "ok"}), 200
+
+# --- Async Process Handling ---
+async def run_process_async(command, timeout):
+    popen_kwargs = {}
+    if core.FAST_SPAWN:
+        command = [core.resolve_executable(command[0])] + list(command[1:])
+        popen_kwargs['close_fds'] = False
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **popen_kwargs
+    )
+    core.SPAWN_STATS.record(time.perf_counter() - started)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # Timeouts and cancelled requests must not leave gs running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, command,
+            output=stdout.decode(errors='replace'), stderr=stderr.decode(errors='replace')
+        )
+    return stdout
+
+def release_abandoned_slot(slot, entered):
+    # The wait for a slot was cancelled, but the thread may still have obtained one
+    if not entered.cancelled() and entered.exception() is None:
+        slot.__exit__(None, None, None)
+
+@contextlib.asynccontextmanager
+async def gs_slot(cost):
+    # Waits for a GS_LIMITER slot in a worker thread so the event loop never blocks
+    slot = core.GS_LIMITER.slot(cost)
+    entered = asyncio.ensure_future(in_slot_thread(slot.__enter__))
+    try:
+        await asyncio.shield(entered)
+    except asyncio.CancelledError:
+        entered.add_done_callback(functools.partial(release_abandoned_slot, slot))
+        raise
+    try:
+        yield
+    finally:
+        slot.__exit__(None, None, None)
+
+async def run_ghostscript_async(input_path, output_path, resolution, first_page=None, last_page=None, cost=None, profile=None):
+    command = core.pdfwrite_command(output_path, resolution, profile)
+    if first_page is not None:
+        command += [f'-dFirstPage={first_page}', f'-dLastPage={last_page}']
+    command.append(input_path)
+    if cost is None:
+        cost = core.estimate_job_cost(input_path)
+    async with gs_slot(cost):
+        await run_process_async(command, core.GS_TIMEOUT_SECONDS)
+
+async def compress_pdf_async(input_path, output_path, resolution, inventory=None):
+    # Same as core.compress_pdf. Only Ghostscript is awaited here (large documents go
+    # through parallel page-range chunks); the in-process engines run in a thread.
+    engine = core.resolve_engine(None, input_path, inventory, resolution)
+    if engine != 'ghostscript':
+        return await in_slot_thread(core.compress_pdf, input_path, output_path, resolution, inventory, engine)
+    started = time.monotonic()
+    page_count = None
+    profile = core.select_gs_profile(input_path, inventory)
+    if core.PARALLEL_PAGES_THRESHOLD > 0:
+        page_count = await asyncio.to_thread(core.get_page_count, input_path, inventory)
+    if page_count and page_count >= core.PARALLEL_PAGES_THRESHOLD:
+        app.logger.info(f"Running parallel GS with resolution: {resolution} DPI on {os.path.basename(input_path)}")
+        await run_ghostscript_parallel_async(input_path, output_path, resolution, page_count, inventory, profile)
+    else:
+        app.logger.info(f"Running GS with resolution: {resolution} DPI ({profile} profile) on {os.path.basename(input_path)}")
+        await run_ghostscript_async(
+            input_path, output_path, resolution, cost=core.estimate_job_cost(input_path, page_count, inventory), profile=profile
+        )
+    if core.OPTIMIZE_OUTPUTS:
+        await in_slot_thread(core.optimize_output, output_path)
+    seconds = time.monotonic() - started
+    core.ENGINE_STATS.record(engine, seconds, core.file_size(input_path), core.file_size(output_path))
+    return {'engine': engine, 'seconds': round(seconds, 3)}
+
+async def run_ghostscript_parallel_async(input_path, output_path, resolution, page_count, inventory=None, profile=None):
+    chunk_dir = core.SCRATCH.directory('gs-chunks', size_hint=core.file_size(input_path))
+    try:
+        chunk_paths = []
+        tasks = []
+        for first_page in range(1, page_count + 1, core.PARALLEL_CHUNK_PAGES):
+            last_page = min(first_page + core.PARALLEL_CHUNK_PAGES - 1, page_count)
+            chunk_path = os.path.join(chunk_dir, f'{first_page:06d}.pdf')
+            cost = core.estimate_job_cost(input_path, page_count, inventory, first_page, last_page)
+            chunk_paths.append(chunk_path)
+            tasks.append(asyncio.ensure_future(
+                run_ghostscript_async(input_path, chunk_path, resolution, first_page, last_page, cost, profile)
+            ))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        await run_process_async(core.merge_command(chunk_paths, output_path), core.GS_TIMEOUT_SECONDS)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+# --- Initial Compression Route ---
+@app.route('/compress-initial', methods=['POST'])
+async def compress_initial():
+    app.logger.info("--- Received request for /compress-initial ---")
+    files = await request.files
+    if 'pdf' not in files:
+        return jsonify({"error": "No PDF file part"}), 400
+
+    try:
+        original_path, digest = await asyncio.to_thread(core.save_upload, files['pdf'])
+    except core.UploadTooLargeError as e:
+        return jsonify({"error": str(e)}), 413
+    except OSError as e:
+        app.logger.error(f"Could not store upload: {str(e)}")
+        return jsonify({"error": "Failed to store the uploaded file."}), 507
+
+    file_id = str(uuid.uuid4())
+    try:
+        baseline_path = await create_baseline_async(file_id, digest, original_path)
+        run = await asyncio.to_thread(core.FILE_CACHE.get_meta, digest, 'engine:baseline') or {}
+        return jsonify({
+            "message": "success",
+            "file_id": file_id,
+            "size": os.path.getsize(baseline_path),
+            "engine": run.get('engine'),
+            "engine_seconds": run.get('seconds')
+        })
+    except core.QueueFullError:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error in initial compression: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to create initial compressed file."}), 500
+
+async def create_baseline_async(file_id, digest, original_path):
+    # Same steps as core.create_baseline, with Ghostscript awaited instead of blocking
+    try:
+        baseline_path = await asyncio.to_thread(core.reuse_baseline, file_id, digest, original_path)
+        if baseline_path:
+            return baseline_path
+
+        baseline_path = core.SCRATCH.path('.pdf', size_hint=core.file_size(original_path))
+        try:
+            original_images = await asyncio.to_thread(core.analyze_pdf_images, original_path)
+            if core.pass_can_shrink_images(original_images, core.BASELINE_RESOLUTION) or core.rewrites_noop_passes():
+                core.GS_LIMITER.admit()
+                try:
+                    run = await compress_pdf_async(original_path, baseline_path, core.BASELINE_RESOLUTION, original_images)
+                finally:
+                    core.GS_LIMITER.release_admission()
+                baseline_images = None
+            else:
+                app.logger.info(f"No images above {core.BASELINE_RESOLUTION} DPI in upload for ID {file_id}, skipping Ghostscript")
+                shutil.move(original_path, baseline_path)
+                baseline_images = original_images
+                run = core.SKIPPED_RUN
+        except BaseException:
+            if os.path.exists(baseline_path):
+                os.remove(baseline_path)
+            raise
+
+        return await asyncio.to_thread(
+            core.register_baseline, file_id, digest, original_path, baseline_path, original_images, baseline_images, run
+        )
+    finally:
+        # Clean up the original uploaded temp file
+        if os.path.exists(original_path):
+            os.remove(original_path)
+
+# --- Adjustment and Download Route ---
+@app.route('/adjust-and-download', methods=['POST'])
+async def adjust_and_download():
+    data = await request.get_json() or {}
+    file_id = data.get('file_id')
+    quality_value = data.get('quality', '7') # Default to 300 DPI
+    app.logger.info(f"--- Received request for /adjust-and-download for ID {file_id} ---")
+
+    resolution = core.get_gs_resolution(quality_value)
+    digest, baseline_path = await asyncio.to_thread(core.FILE_CACHE.lookup, file_id) if file_id else (None, None)
+    if baseline_path is None:
+        return jsonify({"error": "Invalid or expired file ID."}), 404
+
+    adjusted_path = None
+    cached = False
+    try:
+        adjusted_path, cached = await get_or_build_output_async(digest, baseline_path, resolution)
+        # Opened before returning, so an uncached output can be unlinked right away
+        source = open(adjusted_path, 'rb')
+        try:
+            size = os.fstat(source.fileno()).st_size
+            run = await asyncio.to_thread(core.FILE_CACHE.get_meta, digest, f'engine:{resolution}')
+            response = Response(stream_file(source), mimetype='application/pdf')
+        except BaseException:
+            source.close()
+            raise
+        response.headers['Content-Length'] = str(size)
+        response.headers['Content-Disposition'] = f'attachment; filename=compressed-{resolution}dpi.pdf'
+        return core.engine_headers(response, run)
+    except core.QueueFullError:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error in adjustment compression: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to adjust file."}), 500
+    finally:
+        if adjusted_path and not cached and os.path.exists(adjusted_path):
+            os.remove(adjusted_path)
+
+async def stream_file(source):
+    try:
+        while True:
+            chunk = await asyncio.to_thread(source.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        source.close()
+
+async def get_or_build_output_async(digest, baseline_path, resolution):
+    # Same single-flight protocol as core.get_or_build_output, shared with its builds
+    key = (digest, resolution)
+    while True:
+        cached_path = await asyncio.to_thread(core.get_cached_output, digest, resolution)
+        if cached_path:
+            return cached_path, True
+
+        with core.PENDING_OUTPUTS_LOCK:
+            pending_job = core.PENDING_OUTPUTS.get(key)
+            if pending_job is not None and pending_job.cancel():
+                pending_job = None
+            if pending_job is None:
+                core.GS_LIMITER.admit()
+                leader_job = Future()
+                leader_job.set_running_or_notify_cancel()
+                core.PENDING_OUTPUTS[key] = leader_job
+                break
+
+        app.logger.info(f"Waiting on in-flight build of {resolution} DPI for {digest[:12]}")
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(pending_job), core.GS_TIMEOUT_SECONDS)
+        except Exception:
+            pass # Loop and run GS ourselves unless someone else has started
+        cached_path = await asyncio.to_thread(core.get_cached_output, digest, resolution)
+        if cached_path:
+            return cached_path, True
+        with core.PENDING_OUTPUTS_LOCK:
+            if core.PENDING_OUTPUTS.get(key) is pending_job:
+                del core.PENDING_OUTPUTS[key]
+
+    try:
+        result = await build_adjusted_output_async(digest, baseline_path, resolution)
+    except BaseException as e:
+        leader_job.set_exception(e)
+        raise
+    else:
+        leader_job.set_result(result[1])
+        return result
+    finally:
+        with core.PENDING_OUTPUTS_LOCK:
+            if core.PENDING_OUTPUTS.get(key) is leader_job:
+                del core.PENDING_OUTPUTS[key]
+        core.GS_LIMITER.release_admission()
+
+async def build_adjusted_output_async(digest, baseline_path, resolution):
+    # Same as core.build_adjusted_output; an uncached path belongs to the caller
+    source_path, source_kind = await asyncio.to_thread(core.select_source, digest, baseline_path, resolution)
+    adjusted_path = core.SCRATCH.path('.pdf', size_hint=core.file_size(source_path))
+    try:
+        inventory = await asyncio.to_thread(core.get_image_inventory, digest, source_path, source_kind)
+        if core.pass_can_shrink_images(inventory, resolution) or core.rewrites_noop_passes():
+            app.logger.info(f"Deriving {resolution} DPI for {digest[:12]} from the {source_kind} artifact")
+            run = await compress_pdf_async(source_path, adjusted_path, resolution, inventory)
+        else:
+            app.logger.info(f"No images above {resolution} DPI in the {source_kind} of {digest[:12]}, reusing it")
+            await asyncio.to_thread(core.link_or_copy, source_path, adjusted_path)
+            run = core.SKIPPED_RUN
+    except BaseException:
+        if os.path.exists(adjusted_path):
+            os.remove(adjusted_path)
+        raise
+    await asyncio.to_thread(core.FILE_CACHE.set_meta, digest, f'engine:{resolution}', run)
+    return adjusted_path, await asyncio.to_thread(core.store_adjusted_output, digest, resolution, adjusted_path)
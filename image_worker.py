@@ -0,0 +1,45 @@
+import io
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# --- Image Resampling Worker ---
+# Runs in the re-encoding engine's process pool, so it only depends on Pillow and
+# NumPy (never on app.py). A job is a dict:
+#   source: JPEG bytes (kind 'jpeg') or decoded 8-bit samples (kind 'raw')
+#   mode: 'RGB' or 'L'; width, height: source pixel size
+#   target_width, target_height: size to resample to
+#   encode: 'jpeg' or 'flate'; quality: JPEG quality
+#   gray_tolerance: RGB images whose channels never differ by more are stored as gray
+# and the result is {data, filter, mode, width, height}.
+
+def load_image(job):
+    if job['kind'] == 'jpeg':
+        image = Image.open(io.BytesIO(job['source']))
+        # Lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding, never below the target
+        image.draft(job['mode'], (job['target_width'], job['target_height']))
+        if image.mode != job['mode']:
+            image = image.convert(job['mode'])
+        return image
+    return Image.frombytes(job['mode'], (job['width'], job['height']), job['source'])
+
+def resample_image(job):
+    image = load_image(job)
+    target_size = (job['target_width'], job['target_height'])
+    if image.size != target_size:
+        # reducing_gap box-reduces by an integer factor first, then filters the remainder
+        image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+
+    if image.mode == 'RGB':
+        pixels = np.asarray(image)
+        if int(np.ptp(pixels, axis=2).max()) <= job['gray_tolerance']:
+            image = Image.fromarray(pixels.mean(axis=2).round().astype(np.uint8), 'L')
+
+    if job['encode'] == 'jpeg':
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=job['quality'], optimize=True)
+        data, filter_name = buffer.getvalue(), '/DCTDecode'
+    else:
+        data, filter_name = zlib.compress(image.tobytes(), 6), '/FlateDecode'
+    return {'data': data, 'filter': filter_name, 'mode': image.mode, 'width': image.width, 'height': image.height}
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# app.py reads its configuration at import time, so point it at throwaway locations
+# before any test module imports it
+SCRATCH_ROOT = tempfile.mkdtemp(prefix='pdf-compressor-tests-')
+os.environ.setdefault('CACHE_DB_PATH', os.path.join(SCRATCH_ROOT, 'cache.sqlite3'))
+os.environ.setdefault('SCRATCH_DISK_DIR', os.path.join(SCRATCH_ROOT, 'scratch'))
+os.environ.setdefault('SCRATCH_RAM_DIR', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,20 @@
+import app as core
+
+def names(*filenames):
+    used_names = set()
+    return [core.batch_entry_name(filename, used_names) for filename in filenames]
+
+def test_names_keep_the_uploaded_file_name():
+    assert names('report.pdf', 'Scan.PDF') == ['report.pdf', 'Scan.PDF']
+
+def test_duplicate_names_are_numbered():
+    assert names('a.pdf', 'a.pdf', 'a.pdf', 'a (2).pdf') == ['a.pdf', 'a (2).pdf', 'a (3).pdf', 'a (2) (2).pdf']
+
+def test_directories_are_stripped():
+    assert names('../../etc/passwd.pdf', 'C:\\Users\\me\\doc.pdf', 'dir/') == ['passwd.pdf', 'doc.pdf', 'document.pdf']
+
+def test_missing_names_get_a_default():
+    assert names(None, '', None) == ['document.pdf', 'document (2).pdf', 'document (3).pdf']
+
+def test_other_extensions_get_pdf_appended():
+    assert names('notes.txt', 'archive.tar.gz', 'README') == ['notes.txt.pdf', 'archive.tar.gz.pdf', 'README.pdf']
@@ -0,0 +1,148 @@
+import pytest
+
+import app as core
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.time, 'time', clock)
+    return clock
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        return core.MemoryCacheBackend()
+    return core.SQLiteCacheBackend(str(tmp_path / 'cache.sqlite3'))
+
+@pytest.fixture
+def make_file(tmp_path):
+    def make_file(name, size):
+        path = tmp_path / name
+        path.write_bytes(b'x' * size)
+        return str(path)
+    return make_file
+
+def test_identical_uploads_share_the_first_baseline(cache, clock, make_file):
+    first = make_file('first.pdf', 100)
+    second = make_file('second.pdf', 100)
+    assert cache.add_content('d1', first, 'id-a') == first
+    assert cache.add_content('d1', second, 'id-b') == first
+    assert cache.attach_file_id('id-c', 'd1') == first
+    for file_id in ('id-a', 'id-b', 'id-c'):
+        assert cache.lookup(file_id) == ('d1', first)
+    assert cache.stats()['contents'] == 1
+    assert cache.stats()['file_ids'] == 3
+
+def test_attach_needs_an_existing_baseline_file(cache, clock, make_file, tmp_path):
+    assert cache.attach_file_id('id-a', 'unknown') is None
+    baseline = make_file('baseline.pdf', 100)
+    cache.add_content('d1', baseline, 'id-a')
+    (tmp_path / 'baseline.pdf').unlink()
+    assert cache.attach_file_id('id-b', 'd1') is None
+
+def test_file_ids_expire_after_their_last_access(cache, clock, make_file):
+    baseline = make_file('baseline.pdf', 100)
+    output = make_file('out-72.pdf', 50)
+    cache.add_content('d1', baseline, 'id-a')
+    cache.set_output('d1', 72, output)
+    clock.now += 50
+    assert cache.lookup('id-a') == ('d1', baseline)
+    clock.now += 50
+    # Idle for 50 s only: the lookup slid the deadline
+    assert cache.expire(60) == []
+    clock.now += 61
+    assert sorted(cache.expire(60)) == sorted([baseline, output])
+    assert cache.lookup('id-a') == (None, None)
+    assert cache.get_output('d1', 72) is None
+    stats = cache.stats()
+    assert stats['expired_file_ids'] == 1
+    assert stats['expired_contents'] == 1
+
+def test_content_lives_while_any_file_id_does(cache, clock, make_file):
+    baseline = make_file('baseline.pdf', 100)
+    cache.add_content('d1', baseline, 'id-a')
+    clock.now += 50
+    cache.attach_file_id('id-b', 'd1')
+    clock.now += 20
+    assert cache.expire(60) == []
+    assert cache.lookup('id-a') == (None, None)
+    assert cache.lookup('id-b') == ('d1', baseline)
+    clock.now += 61
+    assert cache.expire(60) == [baseline]
+    assert cache.stats()['contents'] == 0
+
+def test_meta_goes_with_its_content(cache, clock, make_file):
+    cache.set_meta('d1', 'images:baseline', {'max_dpi': 300})
+    assert cache.get_meta('d1', 'images:baseline') is None
+    cache.add_content('d1', make_file('baseline.pdf', 100), 'id-a')
+    cache.set_meta('d1', 'images:baseline', {'max_dpi': 300})
+    assert cache.get_meta('d1', 'images:baseline') == {'max_dpi': 300}
+    clock.now += 61
+    cache.expire(60)
+    assert cache.get_meta('d1', 'images:baseline') is None
+
+def test_set_output_reports_the_replaced_file(cache, clock, make_file):
+    assert cache.set_output('d1', 72, make_file('orphan.pdf', 10)) == (False, None)
+    cache.add_content('d1', make_file('baseline.pdf', 100), 'id-a')
+    first = make_file('first.pdf', 50)
+    second = make_file('second.pdf', 40)
+    assert cache.set_output('d1', 72, first) == (True, None)
+    assert cache.set_output('d1', 72, first) == (True, None)
+    assert cache.set_output('d1', 72, second) == (True, first)
+    assert cache.list_outputs('d1') == {72: (second, 40)}
+
+def test_eviction_drops_least_recently_used_outputs_first(cache, clock, make_file):
+    baseline_a = make_file('a.pdf', 100)
+    output_a = make_file('a-72.pdf', 50)
+    baseline_b = make_file('b.pdf', 100)
+    cache.add_content('da', baseline_a, 'id-a')
+    clock.now += 1
+    cache.set_output('da', 72, output_a)
+    clock.now += 1
+    cache.add_content('db', baseline_b, 'id-b')
+    clock.now += 1
+    # Using the baseline does not refresh its outputs
+    cache.lookup('id-a')
+    assert cache.evict(300) == []
+    assert cache.evict(200) == [output_a]
+    assert cache.lookup('id-a') == ('da', baseline_a)
+    assert cache.stats()['evicted_outputs'] == 1
+    assert cache.stats()['evicted_bytes'] == 50
+
+def test_evicting_a_baseline_takes_its_outputs(cache, clock, make_file):
+    baseline_a = make_file('a.pdf', 100)
+    output_a = make_file('a-72.pdf', 50)
+    baseline_b = make_file('b.pdf', 100)
+    cache.add_content('da', baseline_a, 'id-a')
+    cache.set_output('da', 72, output_a)
+    clock.now += 1
+    cache.add_content('db', baseline_b, 'id-b')
+    clock.now += 1
+    cache.get_output('da', 72)
+    # b is the least recently used artifact now
+    assert cache.evict(150) == [baseline_b]
+    assert sorted(cache.evict(0)) == sorted([baseline_a, output_a])
+    assert cache.lookup('id-a') == (None, None)
+    stats = cache.stats()
+    assert stats['evicted_baselines'] == 2
+    assert stats['bytes'] == 0
+
+def test_eviction_spares_the_file_about_to_be_served(cache, clock, make_file):
+    baseline_a = make_file('a.pdf', 100)
+    output_a = make_file('a-72.pdf', 50)
+    baseline_b = make_file('b.pdf', 100)
+    cache.add_content('da', baseline_a, 'id-a')
+    cache.set_output('da', 72, output_a)
+    clock.now += 1
+    cache.add_content('db', baseline_b, 'id-b')
+    # Neither the kept output nor the baseline it belongs to may go
+    assert cache.evict(100, keep_path=output_a) == [baseline_b]
+    assert cache.evict(0, keep_path=baseline_a) == [output_a]
+    assert cache.lookup('id-a') == ('da', baseline_a)
@@ -0,0 +1,46 @@
+import pytest
+
+import app as core
+
+@pytest.fixture(autouse=True)
+def four_sample_pages(monkeypatch):
+    monkeypatch.setattr(core, 'ESTIMATE_SAMPLE_PAGES', 4)
+
+def test_unknown_page_count_samples_the_first_pages():
+    assert core.choose_sample_pages(None) == [1, 2, 3, 4]
+
+def test_short_documents_are_sampled_whole():
+    assert core.choose_sample_pages(3) == [1, 2, 3]
+    assert core.choose_sample_pages(4) == [1, 2, 3, 4]
+
+def test_sample_pages_are_spread_through_the_document():
+    assert core.choose_sample_pages(100) == [13, 38, 63, 88]
+    assert core.choose_sample_pages(5) == [1, 2, 4, 5]
+
+@pytest.mark.parametrize('page_count', [5, 7, 10, 99, 1000])
+def test_sample_pages_are_distinct_and_in_range(page_count):
+    pages = core.choose_sample_pages(page_count)
+    assert len(pages) == 4
+    assert pages == sorted(set(pages))
+    assert 1 <= pages[0] and pages[-1] <= page_count
+
+def test_identical_ratios_give_a_tight_estimate():
+    assert core.estimate_from_ratios([0.5] * 4, 1000, 100) == (500, 500, 500)
+
+def test_spread_of_ratios_gives_the_bounds():
+    # mean 0.3, sample variance 0.02, finite-population correction 1 - 2/100
+    assert core.estimate_from_ratios([0.2, 0.4], 1000, 100) == (300, 102, 498)
+
+def test_sampling_every_page_is_exact():
+    assert core.estimate_from_ratios([0.2, 0.4], 1000, 2) == (300, 300, 300)
+
+def test_one_sampled_page_of_many_is_loose():
+    assert core.estimate_from_ratios([0.4], 1000, 10) == (400, 200, 600)
+    assert core.estimate_from_ratios([0.4], 1000, None) == (400, 200, 600)
+    assert core.estimate_from_ratios([0.4], 1000, 1) == (400, 400, 400)
+
+def test_lower_bound_never_goes_negative():
+    size, low, high = core.estimate_from_ratios([0.01, 0.9], 1000, 1000)
+    assert low == 0
+    assert size == 455
+    assert high > size
@@ -0,0 +1,107 @@
+import pikepdf
+import pytest
+from pikepdf import Array, Dictionary, Name
+
+import app as core
+
+@pytest.fixture(autouse=True)
+def skip_noop_passes(monkeypatch):
+    monkeypatch.setattr(core, 'SKIP_NOOP_PASSES', True)
+
+def gray_image(pdf, width=300, height=200):
+    return pdf.make_stream(
+        b'\x00' * (width * height), Type=Name.XObject, Subtype=Name.Image,
+        Width=width, Height=height, ColorSpace=Name.DeviceGray, BitsPerComponent=8
+    )
+
+def save_page(tmp_path, pdf, content, resources):
+    page = pdf.add_blank_page(page_size=(612, 792))
+    page.obj.Resources = resources
+    page.obj.Contents = pdf.make_stream(content)
+    path = str(tmp_path / 'test.pdf')
+    pdf.save(path)
+    return path
+
+def analyze(path):
+    inventory = core.analyze_pdf_images(path)
+    assert inventory is not None
+    return inventory
+
+def test_image_inherited_from_the_page_tree(tmp_path):
+    # Built without touching pdf.pages, which would push /Resources down onto the page
+    pdf = pikepdf.new()
+    page = pdf.make_indirect(Dictionary(Type=Name.Page, Contents=pdf.make_stream(b'q 72 0 0 48 0 0 cm /Im0 Do Q')))
+    pages = pdf.Root.Pages
+    pages.Kids = Array([page])
+    pages.Count = 1
+    pages.MediaBox = Array([0, 0, 612, 792])
+    pages.Resources = Dictionary(XObject=Dictionary(Im0=gray_image(pdf)))
+    page.Parent = pages
+    path = str(tmp_path / 'inherited.pdf')
+    pdf.save(path)
+    # Opening the file pushes inherited attributes down, so check the bytes as written
+    with open(path, 'rb') as f:
+        written = f.read()
+    [pages_line] = [line for line in written.splitlines() if b'/Type /Pages' in line]
+    assert written.count(b'/Resources') == 1 and b'/Resources' in pages_line
+    inventory = analyze(path)
+    assert [image['dpi'] for image in inventory['images']] == [300.0]
+    assert core.pass_can_shrink_images(inventory, 150)
+    assert not core.pass_can_shrink_images(inventory, 200)
+
+def test_image_inside_a_form_xobject(tmp_path):
+    pdf = pikepdf.new()
+    form = pdf.make_stream(
+        b'q 144 0 0 96 0 0 cm /Im0 Do Q', Type=Name.XObject, Subtype=Name.Form,
+        BBox=Array([0, 0, 144, 96]), Matrix=Array([0.5, 0, 0, 0.5, 0, 0]),
+        Resources=Dictionary(XObject=Dictionary(Im0=gray_image(pdf)))
+    )
+    path = save_page(tmp_path, pdf, b'q 1 0 0 1 100 100 cm /Fm0 Do Q', Dictionary(XObject=Dictionary(Fm0=form)))
+    inventory = analyze(path)
+    assert inventory['max_dpi'] == 300.0
+    assert core.pass_can_shrink_images(inventory, 150)
+    assert not core.pass_can_shrink_images(inventory, 200)
+
+def test_inline_image(tmp_path):
+    pdf = pikepdf.new()
+    content = b'q 7.2 0 0 4.8 0 0 cm BI /W 30 /H 20 /CS /G /BPC 8 ID ' + b'\x00' * 600 + b'\nEI Q'
+    path = save_page(tmp_path, pdf, content, Dictionary())
+    inventory = analyze(path)
+    [image] = inventory['images']
+    assert image['object'] is None
+    assert (image['width'], image['height'], image['dpi']) == (30, 20, 300.0)
+    assert core.pass_can_shrink_images(inventory, 150)
+    assert not core.pass_can_shrink_images(inventory, 200)
+
+def test_rotated_placement(tmp_path):
+    # Rotated by 90 degrees the image still covers 72 x 48 points
+    pdf = pikepdf.new()
+    path = save_page(
+        tmp_path, pdf, b'q 0 72 -48 0 200 200 cm /Im0 Do Q',
+        Dictionary(XObject=Dictionary(Im0=gray_image(pdf)))
+    )
+    inventory = analyze(path)
+    assert inventory['max_dpi'] == 300.0
+    assert core.pass_can_shrink_images(inventory, 150)
+
+def test_scaled_placements_keep_the_highest_dpi(tmp_path):
+    # The page scale composes with each placement: 144 x 96 points is 150 DPI, 36 x 24 is 600
+    pdf = pikepdf.new()
+    content = b'0.5 0 0 0.5 0 0 cm q 288 0 0 192 0 0 cm /Im0 Do Q q 72 0 0 48 300 300 cm /Im0 Do Q'
+    path = save_page(tmp_path, pdf, content, Dictionary(XObject=Dictionary(Im0=gray_image(pdf))))
+    inventory = analyze(path)
+    [image] = inventory['images']
+    assert image['dpi'] == 600.0
+    assert core.pass_can_shrink_images(inventory, 300)
+    assert not core.pass_can_shrink_images(inventory, 400)
+
+def test_only_large_placement_is_skipped(tmp_path):
+    pdf = pikepdf.new()
+    path = save_page(
+        tmp_path, pdf, b'q 288 0 0 192 0 0 cm /Im0 Do Q',
+        Dictionary(XObject=Dictionary(Im0=gray_image(pdf)))
+    )
+    inventory = analyze(path)
+    assert inventory['max_dpi'] == 75.0
+    assert not core.pass_can_shrink_images(inventory, 72)
+    assert core.pass_can_shrink_images(None, 72)
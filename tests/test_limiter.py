@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+import app as core
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(core.time, 'monotonic', clock)
+    return clock
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "timed out"
+        time.sleep(0.01)
+
+def queue_jobs(limiter, clock, jobs):
+    # jobs: [(name, cost, enqueued at)]; returns the names in the order they ran
+    order = []
+    threads = []
+
+    def run(name, cost):
+        with limiter.slot(cost):
+            order.append(name)
+
+    for name, cost, enqueued in jobs:
+        clock.now = enqueued
+        thread = threading.Thread(target=run, args=(name, cost))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: limiter.waiting == len(threads))
+    return order, threads
+
+def run_queued(limiter, clock, jobs):
+    holder = limiter.slot(0)
+    holder.__enter__()
+    order, threads = queue_jobs(limiter, clock, jobs)
+    holder.__exit__(None, None, None)
+    for thread in threads:
+        thread.join()
+    return order
+
+def test_shortest_job_runs_first(clock):
+    limiter = core.JobLimiter(1, 10)
+    assert run_queued(limiter, clock, [('big', 5.0, 0), ('small', 1.0, 0), ('medium', 3.0, 0)]) == ['small', 'medium', 'big']
+
+def test_aging_lets_a_waiting_large_job_overtake(clock, monkeypatch):
+    monkeypatch.setattr(core, 'GS_SJF_AGING', 1.0)
+    limiter = core.JobLimiter(1, 10)
+    # 10 s of extra cost is worth 10 s of waiting
+    assert run_queued(limiter, clock, [('big', 11.0, 0), ('small', 1.0, 5)]) == ['small', 'big']
+    assert run_queued(limiter, clock, [('big', 11.0, 0), ('small', 1.0, 15)]) == ['big', 'small']
+
+def test_fifo_keeps_arrival_order(clock, monkeypatch):
+    monkeypatch.setattr(core, 'GS_SCHEDULER', 'fifo')
+    limiter = core.JobLimiter(1, 10)
+    assert run_queued(limiter, clock, [('big', 5.0, 0), ('small', 1.0, 1), ('medium', 3.0, 2)]) == ['big', 'small', 'medium']
+
+def test_unknown_cost_counts_as_an_average_job(clock):
+    limiter = core.JobLimiter(1, 10)
+    limiter.avg_seconds = 4.0
+    assert run_queued(limiter, clock, [('big', 5.0, 0), ('unknown', None, 0), ('small', 1.0, 0)]) == ['small', 'unknown', 'big']
+
+def test_slots_run_up_to_max_running_at_once(clock):
+    limiter = core.JobLimiter(2, 10)
+    release = threading.Event()
+
+    def run():
+        with limiter.slot(1.0):
+            release.wait()
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: limiter.running == 2 and limiter.waiting == 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert limiter.completed == 3
+    assert limiter.running == 0
+
+def test_admission_rejects_beyond_running_plus_waiting():
+    limiter = core.JobLimiter(1, 2)
+    for _ in range(3):
+        limiter.admit()
+    with pytest.raises(core.QueueFullError) as rejected:
+        limiter.admit()
+    # Two jobs ahead of one slot, plus this one: three rounds of 10 s
+    assert rejected.value.retry_after == 30
+    assert limiter.rejected == 1
+    limiter.release_admission()
+    limiter.admit()
+
+def test_retry_after_follows_queue_depth_and_latency():
+    limiter = core.JobLimiter(2, 8)
+    limiter.avg_seconds = 10.0
+    assert limiter.retry_after(0, 2) == 5
+    assert limiter.retry_after(6, 2) == 25
+    limiter.avg_seconds = 0.01
+    assert limiter.retry_after(0, 2) == 1